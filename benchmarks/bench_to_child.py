@@ -0,0 +1,38 @@
+"""Micro-benchmark of creating child states
+
+Times ``State.to_child`` on the body of a for loop, the step behind every
+``check_*()`` call, and a chain of checks that zooms in from the root state.
+
+    python benchmarks/bench_to_child.py [number]
+"""
+import sys
+import timeit
+
+from pythonwhat.test_exercise import setup_state
+
+PEC = "import numpy as np\n" + "\n".join("v%d = %d" % (i, i) for i in range(200))
+CODE = "for i in range(3):\n    print(i)\n    x = abs(i)\n"
+
+
+def main(number=2000):
+    chain = setup_state(CODE, CODE, pec=PEC)
+    state = chain._state
+    student_loop = state.ast_dispatcher.for_loops(state.student_ast)[0]
+    solution_loop = state.ast_dispatcher.for_loops(state.solution_ast)[0]
+
+    def to_child():
+        state.to_child(
+            student_ast=student_loop["body"]["node"],
+            solution_ast=solution_loop["body"]["node"],
+        )
+
+    def check_chain():
+        chain.check_for_loop().check_body().has_code("abs")
+
+    for name, func in [("to_child", to_child), ("check_chain", check_chain)]:
+        best = min(timeit.repeat(func, number=number, repeat=5))
+        print("%-12s %8.1f us" % (name, best / number * 1e6))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
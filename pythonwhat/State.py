@@ -1,6 +1,12 @@
+import ast
 import asttokens
+import hashlib
+import inspect
+import threading
 
+from contextvars import ContextVar
 from functools import partialmethod
+from collections import OrderedDict
 from collections.abc import Mapping
 
 from protowhat.failure import debugger
@@ -11,12 +17,8 @@ from protowhat.utils import parameters_attr
 from pythonwhat import signatures
 from pythonwhat.converters import get_manual_converters
 from pythonwhat.feedback import Feedback
-from pythonwhat.parsing import (
-    TargetVars,
-    FunctionParser,
-    ObjectAccessParser,
-    parser_dict,
-)
+from pythonwhat.tasks import RepresentationCache
+from pythonwhat.parsing import TargetVars, TreeIndex, parser_dict
 from pythonwhat.utils_ast import wrap_in_module
 
 
@@ -40,8 +42,32 @@ class Context(Mapping):
         return len(self._items)
 
 
+# root state of the grading running in the current context, see RootStateMeta
+root_state = ContextVar("root_state", default=None)
+
+
+class RootStateMeta(type):
+    """Makes ``State.root_state`` local to the thread or task that sets it
+
+    Gradings that run at the same time (see test_exercise.async_test_exercise)
+    each see their own root state, which is None when it isn't set.
+    """
+
+    @property
+    def root_state(cls):
+        return root_state.get()
+
+    @root_state.setter
+    def root_state(cls, state):
+        root_state.set(state)
+
+    @root_state.deleter
+    def root_state(cls):
+        root_state.set(None)
+
+
 @parameters_attr
-class State(ProtoState):
+class State(ProtoState, metaclass=RootStateMeta):
     """State of the SCT environment.
 
     This class holds all information relevevant to test the correctness of an exercise.
@@ -82,15 +108,15 @@ class State(ProtoState):
         solution_context=Context(),
         student_env=Context(),
         solution_env=Context(),
+        ast_dispatcher=None,
     ):
         args = locals().copy()
+        del args["self"]
         self.debug = False
+        vars(self).update(args)
 
-        for k, v in args.items():
-            if k != "self":
-                setattr(self, k, v)
-
-        self.ast_dispatcher = self.get_dispatcher()
+        if ast_dispatcher is None:
+            self.ast_dispatcher = self.get_dispatcher()
 
         # Parse solution and student code
         # if possible, not done yet and wanted (ast arguments not False)
@@ -103,7 +129,10 @@ class State(ProtoState):
         if highlight is None:  # todo: check parent_state? (move check to reporting?)
             self.highlight = self.student_ast
 
-        self.converters = get_manual_converters()  # accessed only from root state
+        if creator is None:
+            # accessed only from root state, child states share them (see to_child)
+            self.converters = get_manual_converters()
+            self.representations = RepresentationCache()
 
         self.manual_sigs = None
 
@@ -120,17 +149,23 @@ class State(ProtoState):
         student tree and solution tree. This is necessary when testing if statements or
         for loops for example.
         """
-        bad_parameters = set(kwargs) - set(self.parameters)
+        bad_parameters = set(kwargs).difference(self.init_parameters)
         if bad_parameters:
             raise ValueError(
                 "Invalid init parameters for State: %s" % ", ".join(bad_parameters)
             )
 
+        # the dispatcher, parsed code and contexts are passed on, not rebuilt
+        state_vars = vars(self)
         base_kwargs = {
-            attr: getattr(self, attr)
-            for attr in self.parameters
-            if hasattr(self, attr) and attr not in ["ast_dispatcher", "highlight"]
+            attr: state_vars[attr]
+            for attr in self.init_parameters
+            if attr != "highlight"
         }
+        if kwargs.get("pre_exercise_code", self.pre_exercise_code) != (
+            self.pre_exercise_code
+        ):
+            base_kwargs["ast_dispatcher"] = None
 
         if append_message and not isinstance(append_message, FeedbackComponent):
             append_message = FeedbackComponent(append_message)
@@ -172,15 +207,23 @@ class State(ProtoState):
         init_kwargs = {**base_kwargs, **kwargs}
         child = klass(**init_kwargs)
 
-        extra_attrs = set(vars(self)) - set(self.parameters)
-        for attr in extra_attrs:
-            # don't copy attrs set on new instances in init
-            # the cached manual_sigs is passed
-            if attr not in {"ast_dispatcher", "converters"}:
-                setattr(child, attr, getattr(self, attr))
+        # attrs that aren't init parameters, e.g. the caches shared by all
+        # states of an SCT or the path set by check_file
+        for attr in state_vars.keys() - self.init_parameters:
+            setattr(child, attr, state_vars[attr])
 
         return child
 
+    def get_feedback(self, conclusion):
+        # the highlight positions come from the tokens, mark them when failing
+        root = self.state_history[0]
+        if root.student_ast_tokens is not None:
+            root.student_ast_tokens.mark(root.student_ast)
+        if self.student_ast_tokens is not None and not self.highlighting_disabled:
+            self.student_ast_tokens.mark(getattr(self, "highlight", self.student_ast))
+
+        return super().get_feedback(conclusion)
+
     def has_different_processes(self):
         # process classes have an _identity field that is a tuple
         try:
@@ -273,59 +316,215 @@ class State(ProtoState):
                 self.report("Something went wrong when parsing the PEC: %s" % str(e))
 
 
+class ParseCache:
+    """LRU cache of parsed code and values derived from it, shared by gradings
+
+    Entries are keyed by a hash of the code, so the same PEC, solution or
+    submission is parsed once per process. The cache keeps at most ``max_size``
+    codes, of at most ``max_chars`` characters of source code in total, and drops
+    the least recently used codes first. Code longer than ``max_chars`` isn't cached.
+    The trees, tokens and indices of a code aren't measured: they take a multiple
+    of the memory of its source, so ``max_chars`` only bounds them proportionally.
+    Cached trees are shared, so they must not be changed.
+    """
+
+    def __init__(self, max_size=256, max_chars=2 ** 22):
+        self.max_size = max_size
+        self.max_chars = max_chars
+        self.entries = OrderedDict()
+        # gradings in different threads share the cache, codes are parsed unlocked
+        self.lock = threading.Lock()
+        self.chars = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(code):
+        data = code.encode("utf-8", "surrogatepass")
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def get(self, code, name, compute):
+        """Get the value called name for code, from compute() on a miss"""
+        key = self.key(code)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and name in entry:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return entry[name]
+            self.misses += 1
+
+        value = compute()
+        if len(code) > self.max_chars:
+            return value
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = {}
+                self.chars += len(code)
+                entry["size"] = len(code)
+            else:
+                self.entries.move_to_end(key)
+            # a concurrent miss may have computed it first
+            value = entry.setdefault(name, value)
+            self.evict()
+        return value
+
+    def evict(self):
+        while len(self.entries) > self.max_size or self.chars > self.max_chars:
+            _, entry = self.entries.popitem(last=False)
+            self.chars -= entry["size"]
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.chars = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self.entries),
+            "chars": self.chars,
+        }
+
+
+class CodeTokens:
+    """Text and tokens of the nodes of parsed code
+
+    The code is only parsed with ast. The text of statements and expressions is
+    cut from the code at their positions. The tokens of asttokens (``first_token``
+    and ``last_token``, which give the highlight positions) are only marked by
+    ``mark()``, when a node needs them. Passing submissions aren't tokenized.
+    """
+
+    def __init__(self, code, tree):
+        self.code = code
+        self.tree = tree
+        self._atok = None
+        self._line_numbers = None
+
+    def mark(self, node):
+        """Mark the tokens of the code on its tree, and on node if it's derived from it
+
+        Nodes derived from the tree, copies (see parsing.FunctionBodyTransformer)
+        and statements wrapped in a module (see utils_ast.wrap_in_module), get the
+        tokens of the nodes they come from. Other new nodes get none.
+        """
+        if self._atok is None:
+            self._atok = asttokens.ASTTokens(self.code)
+            self._atok.mark_tokens(self.tree)
+        if not isinstance(node, ast.AST) or hasattr(node, "first_token"):
+            return node
+
+        source = getattr(node, "token_source", None)
+        if source is not None:
+            first = last = self.mark(source)
+        elif isinstance(node, ast.Module) and isinstance(node.body, list) and node.body:
+            first, last = self.mark(node.body[0]), self.mark(node.body[-1])
+        else:
+            return node
+
+        if hasattr(first, "first_token") and hasattr(last, "last_token"):
+            node.first_token = first.first_token
+            node.last_token = last.last_token
+        return node
+
+    def get_text(self, node):
+        span = self.get_span(node)
+        if span is None:
+            self.mark(node)
+            return self._atok.get_text(node)
+        return self.code[span[0] : span[1]]
+
+    def get_span(self, node):
+        """Offsets of the text of node in the code, None if its tokens are needed"""
+        if getattr(node, "first_token", None) is not None:
+            return node.first_token.startpos, node.last_token.endpos
+
+        if isinstance(node, ast.Module):
+            # statements wrapped in a module, see utils_ast.wrap_in_module
+            if not isinstance(node.body, list):
+                return None
+            if not node.body:
+                return 0, 0
+            first, last = self.get_span(node.body[0]), self.get_span(node.body[-1])
+            return first and last and (first[0], last[1])
+
+        if (
+            not isinstance(node, (ast.stmt, ast.expr))
+            or getattr(node, "end_lineno", None) is None
+            # the tokens of definitions start at their decorators
+            or getattr(node, "decorator_list", None)
+        ):
+            return None
+
+        return (
+            self.get_offset(node.lineno, node.col_offset),
+            self.get_offset(node.end_lineno, node.end_col_offset),
+        )
+
+    def get_offset(self, lineno, col_offset):
+        # ast column offsets count utf-8 bytes
+        if self._line_numbers is None:
+            self._line_numbers = asttokens.LineNumbers(self.code)
+        column = self._line_numbers.from_utf8_col(lineno, col_offset)
+        return self._line_numbers.line_to_offset(lineno, column)
+
+
 class Dispatcher(DispatcherInterface):
-    _context_cache = dict()
+    # parsed code and context mappings, shared by all dispatchers in a process
+    parse_cache = ParseCache()
+    # False marks the tokens of every parsed tree, instead of those needed
+    lazy_tokens = True
 
     def __init__(self, context_code=""):
-        self._parser_cache = dict()
-        context_ast = getattr(self._context_cache, context_code, None)
-        if context_ast is None:
-            context_ast = self._context_cache[context_code] = self.parse(context_code)[
-                1
-            ]
-        self.context_mappings = self._getx(FunctionParser, "mappings", context_ast)
+        self._indexes = dict()
+        self.context_mappings = self.parse_cache.get(
+            context_code,
+            "mappings",
+            lambda: TreeIndex(self.parse(context_code)[1]).get("mappings"),
+        )
 
     def find(self, name, node, *args, **kwargs):
         return getattr(self, name)(node)
 
     def parse(self, code):
-        res = asttokens.ASTTokens(code, parse=True)
-        return res, res.tree
+        tokens, tree = self.parse_cache.get(
+            code, "parse", lambda: self.parse_code(code)
+        )
+        if not self.lazy_tokens:
+            tokens.mark(tree)
+        return tokens, tree
+
+    @staticmethod
+    def parse_code(code):
+        tree = ast.parse(code)
+        return CodeTokens(code, tree), tree
 
     # add methods for retrieving parser outputs --------------------------
-    def _getx(self, Parser, ext_attr, tree):
+    def _getx(self, key, tree):
         """getter for Parser outputs"""
-        # return cached output if possible
-        cache_key = Parser.__name__ + str(hash(tree))
-        if self._parser_cache.get(cache_key):
-            p = self._parser_cache[cache_key]
-        else:
-            # otherwise, run parser over tree
-            p = Parser()
-            # set mappings for parsers that inspect attribute access
-            if ext_attr != "mappings" and Parser in [
-                FunctionParser,
-                ObjectAccessParser,
-            ]:
-                p.mappings = self.context_mappings.copy()
-            # run parser
-            p.visit(tree)
-            # cache
-            self._parser_cache[cache_key] = p
-        return getattr(p, ext_attr)
-
-
-# put a function on the dispatcher
-for k, Parser in parser_dict.items():
-    setattr(Dispatcher, k, partialmethod(Dispatcher._getx, Parser, "out"))
-
-# mappings from ObjectAccessParser
-prop_oa_map = partialmethod(Dispatcher._getx, ObjectAccessParser, "mappings")
-setattr(Dispatcher, "oa_mappings", prop_oa_map)
-
-# mappings from FunctionParser
-prop_map = partialmethod(Dispatcher._getx, FunctionParser, "mappings")
-setattr(Dispatcher, "mappings", prop_map)
+        # indexes are kept per statements, so statements wrapped in a new module
+        # (see State.to_child) reuse theirs. The index keeps the statements alive,
+        # so their ids aren't reused.
+        nodes = tuple(map(id, TreeIndex.top_level(tree)))
+        index = self._indexes.get(nodes)
+        if index is None:
+            index = self._indexes[nodes] = TreeIndex(tree, self.context_mappings)
+        return index.get(key)
+
+
+# put a function on the dispatcher for every parser output and the mappings
+for k in [*parser_dict, "oa_mappings", "mappings"]:
+    setattr(Dispatcher, k, partialmethod(Dispatcher._getx, k))
+
+
+# the arguments of State, which child states get from vars() in to_child
+State.init_parameters = tuple(inspect.signature(State).parameters)
 
 
 # State subclasses based on parsed output -------------------------------------
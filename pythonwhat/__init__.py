@@ -1,3 +1,3 @@
 __version__ = "2.24.4"
 
-from .test_exercise import test_exercise, allow_errors
+from .test_exercise import test_exercise, async_test_exercise, allow_errors
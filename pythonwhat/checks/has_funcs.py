@@ -1,14 +1,18 @@
 from protowhat.utils_messaging import get_ord
 from pythonwhat.tasks import (
+    content_digest,
+    getDigestInProcess,
     getResultInProcess,
     getOutputInProcess,
     getErrorInProcess,
     ReprFail,
     isDefinedInProcess,
     getOptionFromProcess,
+    execute_tasks,
     UndefinedValue,
 )
 from pythonwhat.Test import EqualTest, DefinedCollTest
+from pythonwhat.local import LazyOutput, LimitExceeded
 from protowhat.Feedback import Feedback, FeedbackComponent
 from protowhat.failure import InstructorError, debugger
 from pythonwhat import utils
@@ -217,6 +221,9 @@ def has_equal_ast(state, incorrect_msg=None, code=None, exact=True, append=None)
 DEFAULT_INCORRECT_MSG = "Expected {{test_desc}}`{{sol_eval}}`, but got `{{stu_eval}}`."
 DEFAULT_ERROR_MSG = "Running {{'it' if parent['part'] else 'the highlighted expression'}} generated an error: `{{stu_str}}`."
 DEFAULT_ERROR_MSG_INV = "Running {{'it' if parent['part'] else 'the highlighted expression'}} didn't generate an error, but it should!"
+DEFAULT_LIMIT_MSG = (
+    "Running {{'it' if parent['part'] else 'the highlighted expression'}} {{stu_str}}."
+)
 DEFAULT_UNDEFINED_NAME_MSG = "Running {{'it' if parent['part'] else 'the highlighted expression'}} should define a variable `{{name}}` without errors, but it doesn't."
 DEFAULT_INCORRECT_NAME_MSG = (
     "Are you sure you assigned the correct value to `{{name}}`?"
@@ -254,7 +261,12 @@ args_string = """
           {0} of an object after executing the body of e.g. a ``for`` loop.
         copy (bool): whether to try to deep copy objects in the environment, such as lists, that could
           accidentally be mutated. Disable to speed up SCTs. Disabling may lead to cryptic mutation issues.
+          Set to ``'fork'`` to run the code in a short-lived copy of the process instead, which discards
+          mutations without copying any objects. Set ``PYTHONWHAT_ISOLATION=fork`` to do this by default.
         func (function): custom binary function of form f(stu_result, sol_result), for equality testing.
+        compare (str): set to ``'digest'`` to compare large values, e.g. DataFrames, by a digest of their
+          content that is computed in the processes, so the values are only sent if the digests differ
+          (to compare them in full and explain the difference). Only for ``has_equal_value()``.
         override: If specified, this avoids the execution of the targeted code in the solution process. Instead, it
           will compare the {0} of the expression in the student process with the value specified in ``override``.
           Typically used in a ``SingleProcessExercise`` or if you want to allow for different solutions other than
@@ -276,6 +288,7 @@ def has_expr(
     copy=True,
     func=None,
     override=None,
+    compare=None,
     test=None,  # todo: default or arg before state
 ):
 
@@ -301,8 +314,7 @@ def has_expr(
     if state.solution_code is not None and isinstance(expr_code, str):
         expr_code = expr_code.replace("__focus__", state.solution_code)
 
-    get_func = partial(
-        evalCalls[test],
+    eval_kwargs = dict(
         extra_env=extra_env,
         context_vals=context_vals,
         pre_code=pre_code,
@@ -310,6 +322,19 @@ def has_expr(
         name=name,
         copy=copy,
     )
+    get_func = partial(evalCalls[test], **eval_kwargs)
+
+    if compare == "digest":
+        if test != "value" or func is not None:
+            raise InstructorError.from_message(
+                "`compare='digest'` can only be used to compare values, without `func`."
+            )
+        if digests_equal(state, partial(getDigestInProcess, **eval_kwargs), override):
+            return state
+    elif compare is not None:
+        raise InstructorError.from_message(
+            "`compare` should be None or 'digest', not %r." % compare
+        )
 
     if override is not None:
         # don't bother with running expression and fetching output/value
@@ -323,6 +348,10 @@ def has_expr(
             env=state.solution_env,
         )
 
+        if isinstance(eval_sol, LimitExceeded):
+            raise InstructorError.from_message(
+                "Evaluating expression in solution process %s" % eval_sol
+            )
         if (test == "error") ^ isinstance(eval_sol, Exception):
             raise InstructorError.from_message(
                 "Evaluating expression raised error in solution process (or didn't raise if testing for one). "
@@ -376,6 +405,11 @@ def has_expr(
         incorrect_msg = "Expected something different."
 
     # tests ---
+    # process stopped running the expression
+    if isinstance(eval_stu, LimitExceeded):
+        fmt_kwargs["stu_str"] = str_stu
+        state.report(DEFAULT_LIMIT_MSG, fmt_kwargs, append=append)
+
     # error in process
     if (test == "error") ^ isinstance(eval_stu, Exception):
         fmt_kwargs["stu_str"] = str_stu
@@ -398,6 +432,32 @@ def has_expr(
     return state
 
 
+def digests_equal(state, get_digest, override=None):
+    """Whether the student and solution values have the same content digest
+
+    Only the digests are sent by the processes. Values without a digest are never
+    equal, so they are compared in full.
+    """
+    if override is not None:
+        sol_digest = content_digest(override)
+    else:
+        sol_digest, _ = get_digest(
+            tree=state.solution_ast,
+            process=state.solution_process,
+            context=state.solution_context,
+            env=state.solution_env,
+        )
+    if not isinstance(sol_digest, str):
+        return False
+    stu_digest, _ = get_digest(
+        tree=state.student_ast,
+        process=state.student_process,
+        context=state.student_context,
+        env=state.student_env,
+    )
+    return stu_digest == sol_digest
+
+
 has_equal_value = partial(has_expr, test="value")
 has_equal_value.__name__ = "has_equal_value"
 has_equal_value.__doc__ = (
@@ -613,9 +673,11 @@ def has_output(state, text, pattern=True, no_output_msg=None):
     if not no_output_msg:
         no_output_msg = "You did not output the correct things."
 
-    state.do_test(
-        StringContainsTest(state.raw_student_output, text, pattern, no_output_msg)
-    )
+    raw_output = state.raw_student_output
+    if isinstance(raw_output, LazyOutput):
+        raw_output = raw_output.get()
+
+    state.do_test(StringContainsTest(raw_output, text, pattern, no_output_msg))
 
     return state
 
@@ -735,12 +797,17 @@ def has_printout(
                 "Error: {} - {}".format(sol_call_str, type(out_sol), str_sol)
             )
 
-    has_output(
-        state,
-        out_sol.strip(),
-        pattern=False,
-        no_output_msg=FeedbackComponent(not_printed_msg, {"sol_call": sol_call_str}),
-    )
+    # a printout that was too long is searched for by the parts that were kept
+    out_sol = out_sol.strip()
+    for part in getattr(out_sol, "parts", [out_sol]):
+        has_output(
+            state,
+            part,
+            pattern=False,
+            no_output_msg=FeedbackComponent(
+                not_printed_msg, {"sol_call": sol_call_str}
+            ),
+        )
 
     return state
 
@@ -826,12 +893,18 @@ def has_chosen(state, correct, msgs):
         )
 
     student_process = state.student_process
-    if not isDefinedInProcess(MC_VAR_NAME, student_process):
+    is_defined, selected_option = execute_tasks(
+        student_process,
+        [
+            isDefinedInProcess.task(MC_VAR_NAME),
+            getOptionFromProcess.task(name=MC_VAR_NAME),
+        ],
+    )
+    if not is_defined:
         raise InstructorError.from_message(
             "Option not available in the student process"
         )
     else:
-        selected_option = getOptionFromProcess(student_process, MC_VAR_NAME)
         if not issubclass(type(selected_option), int):
             raise InstructorError.from_message("selected_option should be an integer")
 
@@ -1,10 +1,24 @@
 import io
 import os
+import pickle
+import asyncio
+import threading
+import time
 import random
+import signal
+import select
+import hashlib
+import importlib
+from queue import Empty
 from pathlib import Path
-from contextlib import redirect_stdout
-
-from multiprocessing import Process, Queue
+from collections import Counter, OrderedDict, deque
+from collections.abc import Sequence
+from contextlib import contextmanager, redirect_stdout
+from contextvars import ContextVar
+from functools import partial
+
+from multiprocessing import AuthenticationError, Process, Queue
+from multiprocessing.connection import Client, Listener
 from protowhat.Reporter import Reporter
 
 try:
@@ -15,6 +29,11 @@ try:
 except:
     BACKEND_AVAILABLE = False
 
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
 
 class StubShell:
     def __init__(self, init_code=None):
@@ -30,17 +49,39 @@ class StubProcess:
     def __init__(self, init_code=None, pid=None):
         self.shell = StubShell(init_code)
         self._identity = (pid,) if pid else (random.randint(0, 1e12),)
+        self.results = deque()
 
     def executeTask(self, task):
+        current = tracer.get()
+        if current is not None:
+            return current.execute(self, task)
         return task(self.shell)
 
+    def submitTask(self, task):
+        self.results.append(task(self.shell))
+
+    def getResult(self):
+        return self.results.popleft()
+
+    def is_alive(self):
+        return True
+
+    def kill(self):
+        pass
+
+
+# number of characters of output kept for a run, the middle part of longer
+# output is dropped (see BoundedOutput), None to keep all output
+OUTPUT_LIMIT = 1024 ** 2
+
 
 class TaskCaptureOutput:
-    def __init__(self, code):
+    def __init__(self, code, limit=None):
         self.code = code
+        self.limit = limit or OUTPUT_LIMIT
 
     def __call__(self, shell):
-        return run_code(shell.run_code, self.code)
+        return run_code(shell.run_code, self.code, self.limit)
 
 
 class TaskKillProcess:
@@ -48,6 +89,424 @@ class TaskKillProcess:
         return None
 
 
+class TaskChDir:
+    def __init__(self, path):
+        self.path = str(path)
+
+    def __call__(self, shell):
+        os.chdir(self.path)
+
+
+def fork():
+    """Fork the process, children keep the state of random, which os.fork reseeds"""
+    random_state = random.getstate()
+    pid = os.fork()
+    if pid == 0:
+        random.setstate(random_state)
+    return pid
+
+
+class TaskFork:
+    """Fork the process, the copy serves tasks sent over a connection to address"""
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+
+    def __call__(self, shell):
+        reap_children()
+        pid = fork()
+        if pid == 0:
+            try:
+                conn = Client(self.address, authkey=self.authkey)
+                # the server checks which child connected
+                conn.send(os.getpid())
+                serve_connection(conn, shell)
+            finally:
+                # never return into the task loop of the process that was copied
+                os._exit(0)
+        return pid
+
+
+# whether this process is a child forked by TaskIsolated
+isolated = False
+
+
+class TaskIsolated:
+    """Run a task in a forked child of the process, so its side effects are discarded
+
+    The child shares the memory of the process until it writes to it,
+    so the namespace doesn't have to be copied to protect it.
+    The answer of the task is pickled back through a pipe.
+    """
+
+    def __init__(self, task):
+        self.task = task
+
+    def __call__(self, shell):
+        read_fd, write_fd = os.pipe()
+        pid = fork()
+        if pid == 0:
+            try:
+                global isolated
+                isolated = True
+                os.close(read_fd)
+                answer = run_task(self.task, shell)
+                try:
+                    data = pickle.dumps(answer)
+                except Exception as e:
+                    data = pickle.dumps(backend_error("can't send answer: %s" % e))
+                with open(write_fd, "wb") as f:
+                    f.write(data)
+            finally:
+                # never return into the task loop of the process that was copied
+                os._exit(0)
+
+        os.close(write_fd)
+        try:
+            with open(read_fd, "rb") as f:
+                data = f.read()
+        except BaseException:
+            # e.g. the time limit was exceeded
+            os.kill(pid, signal.SIGKILL)
+            raise
+        finally:
+            os.waitpid(pid, 0)
+        if not data:
+            return backend_error("isolated process exited without answer")
+        return pickle.loads(data)
+
+
+def backend_error(message):
+    return [{"type": "backend-error", "payload": message}]
+
+
+class LimitExceeded(Exception):
+    """A task ran into a limit of its process, returned as the result of the task"""
+
+
+class TimeLimitExceeded(LimitExceeded):
+    pass
+
+
+class MemoryLimitExceeded(LimitExceeded):
+    pass
+
+
+class TaskLimits:
+    """
+    Time (in seconds) and memory (in bytes) limits for every task run in a process.
+
+    The time limit is enforced with a timer in the process. In case the timer can't
+    interrupt the task, the grader stops waiting ``grace`` seconds later and kills
+    the process. The memory limit caps the address space of the process.
+    """
+
+    grace = 2.0
+
+    def __init__(self, time=None, memory=None):
+        self.time = time
+        self.memory = memory
+
+    def apply(self):
+        """Enforce the limits for the tasks run in the current process"""
+        global task_limits
+        task_limits = self
+        if self.time:
+            signal.signal(signal.SIGALRM, raise_time_limit_exceeded)
+        if self.memory and resource is not None:
+            _, hard = resource.getrlimit(resource.RLIMIT_AS)
+            resource.setrlimit(resource.RLIMIT_AS, (self.memory, hard))
+
+    def time_exceeded(self):
+        return TimeLimitExceeded("took longer than %g seconds" % self.time)
+
+    def memory_exceeded(self):
+        return MemoryLimitExceeded(
+            "used more than %d MB of memory" % (self.memory // 1024 ** 2)
+        )
+
+    def deadline(self, task, previous=None):
+        """Time at which the grader stops waiting for the result of task"""
+        if not self.time:
+            return None
+        start = max(time.monotonic(), previous or 0)
+        return start + self.time * count_tasks(task) + self.grace
+
+
+def count_tasks(task):
+    task = unwrap_task(task)
+    return len(task.tasks) if isinstance(task, TaskBatch) else 1
+
+
+# limits of the tasks run in this process, set in the process by TaskLimits.apply
+task_limits = TaskLimits()
+
+
+def time_left(deadlines):
+    if not deadlines or deadlines[0] is None:
+        return None
+    return max(deadlines[0] - time.monotonic(), 0)
+
+
+def raise_time_limit_exceeded(signum, frame):
+    raise task_limits.time_exceeded()
+
+
+@contextmanager
+def time_limit(seconds):
+    if not seconds:
+        yield
+        return
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+class TaskBatch:
+    """Run several tasks in one round trip, the result is a tuple with their results"""
+
+    def __init__(self, tasks):
+        self.tasks = list(tasks)
+
+    def __call__(self, shell):
+        return tuple(run_task(task, shell) for task in self.tasks)
+
+
+def run_task(task, shell):
+    # the tasks of a batch are limited one by one
+    seconds = None if isinstance(unwrap_task(task), TaskBatch) else task_limits.time
+    output = []
+    with CaptureErrors(output):
+        try:
+            with time_limit(seconds):
+                answer = task(shell)
+        except LimitExceeded as e:
+            answer = e
+        except MemoryError:
+            if not task_limits.memory:
+                raise
+            answer = task_limits.memory_exceeded()
+        # tasks like taskRunEval return the errors of the code they run
+        if isinstance(answer, MemoryError) and task_limits.memory:
+            answer = task_limits.memory_exceeded()
+    if len(output) > 0:  # means backend error happened
+        answer = output
+    return answer
+
+
+def task_name(task):
+    task = unwrap_task(task)
+    if isinstance(task, TaskBatch):
+        return "batch(%s)" % ", ".join(task_name(t) for t in task.tasks)
+    func = getattr(task, "func", task)  # tasks made by process_task are partials
+    return getattr(func, "__name__", type(func).__name__)
+
+
+def unwrap_task(task):
+    return task.task if isinstance(task, TracedTask) else task
+
+
+class TracedResult:
+    def __init__(self, answer, start, end, size):
+        self.answer = answer
+        self.start = start
+        self.end = end
+        self.size = size
+
+
+class TracedTask:
+    """Run a task, recording when it ran and how big its pickled answer is"""
+
+    def __init__(self, task):
+        self.task = task
+
+    def __call__(self, shell):
+        start = time.time()
+        answer = self.task(shell)
+        end = time.time()
+        try:
+            size = len(pickle.dumps(answer))
+        except Exception:
+            size = None
+        return TracedResult(answer, start, end, size)
+
+
+class Tracer:
+    """Record the round trips of the tasks executed in processes
+
+    For every task, the time spent getting it to the process (send), running
+    it (run) and getting its answer back (receive) is recorded, next to the
+    size of the pickled task and answer.
+    Times are taken with time.time, as they are compared across processes.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def execute(self, process, task):
+        try:
+            sent = len(pickle.dumps(task))
+        except Exception:
+            sent = None
+        submitted = time.time()
+        process.submitTask(TracedTask(task))
+        result = process.getResult()
+        received = time.time()
+        record = {
+            "function": task_name(task),
+            "process": process._identity[0],
+            "sent_bytes": sent,
+        }
+        if isinstance(result, TracedResult):
+            record.update(
+                send=result.start - submitted,
+                run=result.end - result.start,
+                receive=received - result.end,
+                received_bytes=result.size,
+            )
+            result = result.answer
+        else:  # e.g. the process died or exceeded a limit
+            record.update(
+                send=None, run=received - submitted, receive=None, received_bytes=None
+            )
+        self.records.append(record)
+        return result
+
+    def report(self):
+        functions = OrderedDict()
+        for record in self.records:
+            summary = functions.setdefault(
+                record["function"],
+                {
+                    "calls": 0,
+                    "send": 0.0,
+                    "run": 0.0,
+                    "receive": 0.0,
+                    "sent_bytes": 0,
+                    "received_bytes": 0,
+                },
+            )
+            summary["calls"] += 1
+            for key in ("send", "run", "receive", "sent_bytes", "received_bytes"):
+                summary[key] += record[key] or 0
+        total = {
+            key: sum(summary[key] for summary in functions.values())
+            for key in (
+                "calls",
+                "send",
+                "run",
+                "receive",
+                "sent_bytes",
+                "received_bytes",
+            )
+        }
+        return {"total": total, "functions": functions, "tasks": self.records}
+
+
+# tracer of the tasks executed from the current thread or task, see tracing
+tracer = ContextVar("tracer", default=None)
+
+
+@contextmanager
+def tracing(enabled=True):
+    """Trace the tasks executed in processes while in this context
+
+    Yields the Tracer, or None if not enabled. Tracing is off by default and
+    then only costs a context variable lookup per task.
+    """
+    if not enabled:
+        yield None
+        return
+    token = tracer.set(Tracer())
+    try:
+        yield tracer.get()
+    finally:
+        tracer.reset(token)
+
+
+async def wait_readable(fd, timeout=None):
+    """Wait until fd is readable, or timeout seconds have passed, without blocking the loop"""
+    loop = asyncio.get_running_loop()
+    readable = loop.create_future()
+    loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+    try:
+        await asyncio.wait_for(readable, timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        loop.remove_reader(fd)
+
+
+def reap_children():
+    try:
+        while os.waitpid(-1, os.WNOHANG)[0]:
+            pass
+    except ChildProcessError:
+        pass
+
+
+def serve_connection(conn, shell):
+    while True:
+        try:
+            next_task = conn.recv()
+        except EOFError:
+            break
+        answer = run_task(next_task, shell)
+        output = []
+        with CaptureErrors(output):
+            conn.send(answer)
+        if len(output) > 0:  # means backend error happened
+            conn.send(output)
+        if isinstance(next_task, TaskKillProcess):
+            break
+
+
+def get_rss(pid):
+    """Resident memory of a process in bytes, 0 if it can't be determined"""
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def pid_alive(pid):
+    """Whether the process with pid runs, also when it isn't a child of this process"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    # a process stays a zombie until its parent, e.g. a template, reaps it
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            return f.read().rpartition(")")[2].split()[0] != "Z"
+    except (OSError, IndexError):
+        return True
+
+
+def preload_modules(modules):
+    for module in modules:
+        # names like numpy.array (from numpy import array) aren't modules,
+        # import the longest part that is
+        while module:
+            try:
+                importlib.import_module(module)
+                break
+            except ImportError:
+                module = module.rpartition(".")[0]
+            except Exception:
+                # a module that can't be imported is reported when the code imports it
+                break
+
+
 class CaptureErrors:
     def __init__(self, output):
         self.output = output
@@ -64,7 +523,7 @@ class CaptureErrors:
 class WorkerProcess(Process):
     instances = []
 
-    def __init__(self, pid=None):
+    def __init__(self, pid=None, preload=(), time_limit=None, memory_limit=None):
         Process.__init__(self)
         self.task_queue = Queue()
         self.result_queue = Queue()
@@ -74,19 +533,27 @@ class WorkerProcess(Process):
         self.instances.append(self)
         # used to detect single process exercise
         self._identity = (pid,) if pid else (random.randint(0, 1e12),)
+        self.preload = tuple(preload)
+        self.limits = TaskLimits(time_limit, memory_limit)
+        self.deadlines = deque()
+        self.exceeded = None
+        self.task_count = 0
 
     def get_shell(self):
         return create({})
 
     def run(self):
+        preload_modules(self.preload)
+        self.limits.apply()
         shell = self.get_shell()
         while True:
             output = []
             with CaptureErrors(output):
                 next_task = self.task_queue.get()
-                answer = next_task(shell)
             if len(output) > 0:  # means backend error happened
                 answer = output
+            else:
+                answer = run_task(next_task, shell)
             output = []
             with CaptureErrors(output):
                 self.result_queue.put_nowait(answer)
@@ -97,17 +564,63 @@ class WorkerProcess(Process):
         return
 
     def executeTask(self, task):
+        current = tracer.get()
+        if current is not None:
+            return current.execute(self, task)
+        self.submitTask(task)
+        return self.getResult()
+
+    def submitTask(self, task):
         self.task_queue.put_nowait(task)
-        return self.result_queue.get()  # wait and fetches next item in queue
+        self.task_count += count_tasks(task)
+        previous = self.deadlines[-1] if self.deadlines else None
+        self.deadlines.append(self.limits.deadline(task, previous))
+
+    def getResult(self):
+        deadline = self.deadlines.popleft() if self.deadlines else None
+        if self.exceeded is not None:
+            return self.exceeded
+        if deadline is None:
+            return self.result_queue.get()  # wait and fetches next item in queue
+        while True:
+            try:
+                return self.result_queue.get(timeout=0.1)
+            except Empty:
+                pass
+            if not self.is_alive():
+                try:
+                    return self.result_queue.get(timeout=0.1)
+                except Empty:
+                    return [
+                        {
+                            "type": "backend-error",
+                            "payload": "process exited with code %s" % self.exitcode,
+                        }
+                    ]
+            if time.monotonic() > deadline:
+                # the timer in the process didn't stop the task, e.g. because
+                # the student code caught the exception
+                self.terminate()
+                self.wait_for_exit(timeout=3.0)
+                self.exceeded = self.limits.time_exceeded()
+                return self.exceeded
+
+    async def getResultAsync(self):
+        if self.exceeded is None and self.is_alive():
+            await wait_readable(
+                self.result_queue._reader.fileno(), time_left(self.deadlines)
+            )
+        # the result is in, or getResult handles the process running out of time
+        return self.getResult()
 
     def kill(self):
         try:
             if self.is_alive():
                 self.executeTask(TaskKillProcess())
-                self.join(timeout=3.0)
+                self.wait_for_exit(timeout=3.0)
                 if self.is_alive():
                     self.terminate()
-                    self.join(timeout=3.0)
+                    self.wait_for_exit(timeout=3.0)
             if self in self.instances:
                 self.instances.remove(self)
         finally:
@@ -115,17 +628,537 @@ class WorkerProcess(Process):
             # python 3.7:
             # self.close()
 
+    def wait_for_exit(self, timeout):
+        # join() also waits for processes forked from this one by TaskFork,
+        # as they inherit the pipe it waits on
+        deadline = time.monotonic() + timeout
+        while self.is_alive() and time.monotonic() < deadline:
+            time.sleep(0.005)
+
     @classmethod
     def kill_all(cls):
         for instance in list(cls.instances):
             instance.kill()
 
+    @classmethod
+    def reap(cls):
+        """Forget processes that exited without being killed, return how many"""
+        dead = [
+            instance
+            for instance in list(cls.instances)
+            if isinstance(instance, Process) and instance.exitcode is not None
+        ]
+        for instance in dead:
+            # the queues of a dead process are broken, free their pipes
+            instance.task_queue.close()
+            instance.result_queue.close()
+            if instance in cls.instances:
+                cls.instances.remove(instance)
+        return len(dead)
+
 
 class SimpleProcess(WorkerProcess):
     def get_shell(self):
         return StubShell()
 
 
+class WorkerPool:
+    """
+    Keep started worker processes ready to be handed out.
+
+    Starting a process and importing heavy modules happens before
+    the code that needs the process comes in, instead of while it waits.
+    The ``preload`` modules can be found with ``preload.PreloadManifest``.
+    A process is handed out only once, so every run starts from a clean process.
+    ``time_limit`` and ``memory_limit`` limit every task run in the processes,
+    see ``TaskLimits``.
+
+    With ``reuse``, runs get copies of templates kept by ``server``, a ``ForkServer``
+    that runs the PEC in processes of the pool and keys the templates by role
+    (student or solution) too. ``size``, ``max_tasks`` and ``max_rss`` limit
+    its templates. Copies are killed when they are released.
+    ``stats`` counts the processes that were started, handed out and reaped.
+    """
+
+    default = None
+
+    def __init__(
+        self,
+        size=2,
+        process_class=SimpleProcess,
+        preload=("numpy", "pandas"),
+        time_limit=None,
+        memory_limit=None,
+        reuse=False,
+        max_tasks=None,
+        max_rss=None,
+    ):
+        self.size = size
+        self.process_class = process_class
+        self.preload = tuple(preload)
+        self.time_limit = time_limit
+        self.memory_limit = memory_limit
+        self.reuse = reuse
+        self.idle = []
+        self.server = ForkServer(
+            max_size=size, max_tasks=max_tasks, max_rss=max_rss, pool=self
+        )
+        self.stats = Counter()
+        # processes can be acquired from the event loop and the SCT thread
+        self.lock = threading.RLock()
+
+    def __enter__(self):
+        self.fill()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def fill(self):
+        with self.lock:
+            self.stats["reaped"] += WorkerProcess.reap()
+            # processes can be killed while idle, e.g. by WorkerProcess.kill_all
+            self.idle = [process for process in self.idle if process.is_alive()]
+            while len(self.idle) < self.size:
+                process = self.new_process()
+                self.idle.append(process)
+
+    def new_process(self):
+        process = self.process_class(
+            preload=self.preload,
+            time_limit=self.time_limit,
+            memory_limit=self.memory_limit,
+        )
+        process.start()
+        self.stats["started"] += 1
+        return process
+
+    def acquire(self, pid=None, key=None):
+        """Hand out a process, with reuse a copy of the template for key if it's given
+
+        ``key`` is a tuple of the PEC, working directory and role of the run,
+        the PEC already ran in the copy.
+        """
+        if self.reuse and key is not None:
+            with self.lock:
+                self.stats["acquired"] += 1
+            # the server takes processes from the pool, not the other way around
+            pec, wd, role = key
+            return self.server.fork(pec, wd, pid, role)
+
+        with self.lock:
+            self.stats["acquired"] += 1
+            self.idle = [process for process in self.idle if process.is_alive()]
+            if self.idle:
+                process = self.idle.pop(0)
+            else:
+                process = self.new_process()
+            self.fill()
+        if pid:
+            process._identity = (pid,)
+        return process
+
+    def release(self, process):
+        """Give back a process that was handed out, when it's no longer needed"""
+        if isinstance(process, LazyProcess):
+            if not process.run.started:
+                return
+            process = process.run.get()[0]
+        process.kill()
+
+    def close(self):
+        self.server.close()
+        for process in self.idle:
+            process.kill()
+        self.idle = []
+
+
+def retire(process, max_tasks=None, max_rss=None, stats=None):
+    """Whether a process ran max_tasks tasks or uses more than max_rss bytes
+
+    The reason is counted in stats, as retired_tasks or retired_rss.
+    """
+    reason = None
+    if max_tasks is not None and process.task_count >= max_tasks:
+        reason = "tasks"
+    elif max_rss is not None and get_rss(process.pid) > max_rss:
+        reason = "rss"
+    if reason and stats is not None:
+        stats["retired_" + reason] += 1
+    return reason is not None
+
+
+def get_pool(process_class, pool=None):
+    """The pool to get processes of process_class from, None if there is none"""
+    pool = pool or WorkerPool.default
+    if pool is not None and pool.process_class is process_class:
+        return pool
+    return None
+
+
+def start_process(process_class, pid=None, pool=None):
+    pool = get_pool(process_class, pool)
+    if pool is not None:
+        process = pool.acquire(pid)
+    else:
+        process = process_class(pid)
+        process.start()
+    return process
+
+
+class ForkedProcess:
+    """Copy of a template process, forked by a ForkServer"""
+
+    def __init__(self, conn, pid, identity=None, limits=None):
+        self.conn = conn
+        self.pid = pid
+        self._identity = (identity,) if identity else (random.randint(0, 1e12),)
+        self.limits = limits or TaskLimits()
+        self.deadlines = deque()
+        self.exceeded = None
+        self.task_count = 0
+        WorkerProcess.instances.append(self)
+
+    def executeTask(self, task):
+        current = tracer.get()
+        if current is not None:
+            return current.execute(self, task)
+        self.submitTask(task)
+        return self.getResult()
+
+    def submitTask(self, task):
+        if self.exceeded is None and not self.conn.closed:
+            try:
+                self.conn.send(task)
+            except OSError:
+                # the copy died, getResult reports it
+                self.conn.close()
+        self.task_count += count_tasks(task)
+        previous = self.deadlines[-1] if self.deadlines else None
+        self.deadlines.append(self.limits.deadline(task, previous))
+
+    def getResult(self):
+        deadline = self.deadlines.popleft() if self.deadlines else None
+        if self.exceeded is not None:
+            return self.exceeded
+        try:
+            if deadline is not None and not self.conn.poll(
+                max(deadline - time.monotonic(), 0)
+            ):
+                self.kill_copy()
+                self.exceeded = self.limits.time_exceeded()
+                return self.exceeded
+            return self.conn.recv()
+        except (EOFError, OSError):
+            # the copy died, e.g. it was killed or exceeded a memory limit
+            self.conn.close()
+            return backend_error("forked process %s exited" % self.pid)
+
+    async def getResultAsync(self):
+        if self.exceeded is None and self.is_alive():
+            await wait_readable(self.conn.fileno(), time_left(self.deadlines))
+        return self.getResult()
+
+    def is_alive(self):
+        return not self.conn.closed and pid_alive(self.pid)
+
+    def kill_copy(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.conn.close()
+
+    def kill(self):
+        try:
+            if self.is_alive():
+                self.submitTask(TaskKillProcess())
+                if self.conn.poll(3.0):
+                    self.getResult()
+                else:
+                    os.kill(self.pid, signal.SIGKILL)
+        except (EOFError, OSError):
+            pass
+        finally:
+            self.conn.close()
+            if self in WorkerProcess.instances:
+                WorkerProcess.instances.remove(self)
+
+
+class ForkServer:
+    """
+    Run the PEC once in a template process and fork a copy of it for every run.
+
+    The copies share the memory of the template until they write to it,
+    so data loaded in the PEC is available without running the PEC again.
+    Templates are kept per PEC, working directory and optionally role. When there
+    are more than ``max_size`` templates, or they use more memory than
+    ``memory_budget`` (in bytes), the least recently used ones are killed.
+    Templates that forked ``max_tasks`` tasks, or use more than ``max_rss`` bytes
+    of memory, are replaced. ``stats`` counts the templates that were started,
+    copies that were forked and templates that were retired.
+    Templates import the ``preload`` modules before the PEC, e.g. the modules the
+    solutions import (see ``preload.PreloadManifest``), so copies don't import them.
+    They are started processes of ``pool`` if it's given (see ``WorkerPool``).
+    When a copy doesn't connect within ``accept_timeout`` seconds, e.g. because it
+    died under a memory limit, the PEC runs in a new process instead.
+    """
+
+    default = None
+
+    def __init__(
+        self,
+        memory_budget=2 * 1024 ** 3,
+        process_class=SimpleProcess,
+        time_limit=None,
+        memory_limit=None,
+        preload=(),
+        accept_timeout=10.0,
+        max_tasks=None,
+        max_rss=None,
+        max_size=None,
+        pool=None,
+    ):
+        self.memory_budget = memory_budget
+        self.process_class = process_class
+        self.preload = tuple(preload)
+        self.time_limit = time_limit
+        self.memory_limit = memory_limit
+        self.accept_timeout = accept_timeout
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.max_size = max_size
+        self.pool = pool
+        self.stats = Counter()
+        self.templates = OrderedDict()
+        self.authkey = os.urandom(32)
+        self.listener = None
+        # copies can be forked from the event loop and the SCT thread,
+        # they connect to the same listener
+        self.lock = threading.RLock()
+
+    @classmethod
+    def get_default(cls):
+        if cls.default is None:
+            cls.default = cls()
+        return cls.default
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def get_key(pec, wd, role=None):
+        parts = [wd, pec] if role is None else [wd, pec, role]
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+    def get_template(self, pec, wd, role=None):
+        key = self.get_key(pec, wd, role)
+        with self.lock:
+            template = self.cached(key)
+            if template is None:
+                template = self.start_process(pec, wd)
+                self.stats["templates"] += 1
+                self.add(key, template)
+            return template
+
+    def cached(self, key):
+        """The template kept for key, None if there is none or it was retired"""
+        with self.lock:
+            template = self.templates.pop(key, None)
+            if template is None:
+                return None
+            if template.is_alive() and not retire(
+                template, self.max_tasks, self.max_rss, self.stats
+            ):
+                # the most recently used template is kept last
+                self.templates[key] = template
+                return template
+            template.kill()
+            return None
+
+    def add(self, key, template):
+        """Keep template for key, it should have run the PEC"""
+        with self.lock:
+            self.templates[key] = template
+            self.evict()
+
+    def discard(self, key, template):
+        """Stop keeping template for key, if it still is"""
+        with self.lock:
+            if self.templates.get(key) is template:
+                del self.templates[key]
+
+    def start_process(self, pec, wd, pid=None):
+        if self.pool is not None:
+            process = self.pool.acquire(pid)
+        else:
+            process = self.process_class(
+                pid,
+                preload=self.preload,
+                time_limit=self.time_limit,
+                memory_limit=self.memory_limit,
+            )
+            process.start()
+        process.executeTask(TaskChDir(wd))
+        _ = process.executeTask(TaskCaptureOutput(pec))
+        return process
+
+    def fork(self, pec, wd, pid=None, role=None):
+        process = self.fork_process(self.get_template(pec, wd, role), pid)
+        if process is None:
+            return self.start_process(pec, wd, pid)
+        return process
+
+    def fork_process(self, template, pid=None):
+        """Fork a copy of the template process, None if the copy didn't connect"""
+        with self.lock:
+            if self.listener is None:
+                self.listener = Listener(family="AF_UNIX", authkey=self.authkey)
+            child_pid = template.executeTask(
+                TaskFork(self.listener.address, self.authkey)
+            )
+            if not isinstance(child_pid, int):
+                raise RuntimeError(
+                    "Forking the template process failed: %s" % child_pid
+                )
+            conn = self.accept(child_pid)
+        if conn is None:
+            try:
+                os.kill(child_pid, signal.SIGKILL)
+            except OSError:
+                pass
+            return None
+        self.stats["forked"] += 1
+        return ForkedProcess(conn, child_pid, pid, limits=template.limits)
+
+    def accept(self, child_pid):
+        """Connection of the child, None if it didn't connect in time"""
+        deadline = time.monotonic() + self.accept_timeout
+        # the socket of the listener, to wait for connections with a timeout
+        sock = self.listener._listener._socket
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or not select.select([sock], [], [], timeout)[0]:
+                return None
+            try:
+                conn = self.listener.accept()
+                connected_pid = conn.recv()
+            except (EOFError, OSError, AuthenticationError):
+                continue
+            if connected_pid == child_pid:
+                return conn
+            # a child that connected after its server gave up on it
+            conn.close()
+
+    def memory_usage(self):
+        return sum(get_rss(template.pid) for template in self.templates.values())
+
+    def evict(self):
+        # the most recently used template is kept, even if it exceeds the budget
+        with self.lock:
+            while len(self.templates) > 1 and (
+                self.max_size is not None
+                and len(self.templates) > self.max_size
+                or self.memory_usage() > self.memory_budget
+            ):
+                _, template = self.templates.popitem(last=False)
+                template.kill()
+
+    def close(self):
+        with self.lock:
+            for template in self.templates.values():
+                template.kill()
+            self.templates.clear()
+            if self.listener is not None:
+                self.listener.close()
+                self.listener = None
+
+
+class SolutionCache:
+    """
+    Keep solution processes alive to reuse them for every submission to an exercise.
+
+    The solution only runs for the first submission with the same PEC, solution code
+    and working directory. Its process is kept as a template by ``server``, a
+    ``ForkServer`` that ``max_size``, ``max_tasks`` and ``max_rss`` limit, and every
+    grading gets a copy forked from it, so evaluations that change the namespace
+    or modules of the copy don't carry over to later gradings.
+    Copies should be killed when their grading is done.
+    Cached processes get a ``memo``, results of evaluations in them are kept there
+    (see ``tasks.memoize``). It keeps the ``memo_size`` most recent results.
+    """
+
+    default = None
+
+    def __init__(self, max_size=32, memo_size=256, max_tasks=None, max_rss=None):
+        self.memo_size = memo_size
+        self.server = ForkServer(
+            max_size=max_size, max_tasks=max_tasks, max_rss=max_rss
+        )
+
+    @staticmethod
+    def get_key(pec, sol_code, wd):
+        return hashlib.sha256("\0".join([wd, pec, sol_code]).encode()).hexdigest()
+
+    def get(self, key):
+        """A copy of the cached solution process, None if there is none"""
+        template = self.server.cached(key)
+        if template is None:
+            return None
+        process = self.fork(key, template)
+        if process is None:
+            template.kill()
+        return process
+
+    def add(self, key, process):
+        """Cache the solution process that just ran, return the process to grade with"""
+        if isinstance(process, StubProcess):
+            # runs in this process, it can't be copied
+            return process
+        with self.server.lock:
+            template = self.server.cached(key)
+            if template is None:
+                template = process
+                template.memo = Memo(self.memo_size)
+                self.server.add(key, template)
+
+        copy = self.fork(key, template)
+        if template is not process:
+            # a concurrent grading cached the solution first
+            if copy is None:
+                template.kill()
+                return process
+            process.kill()
+        return copy or process
+
+    def fork(self, key, template):
+        copy = self.server.fork_process(template, template._identity[0])
+        if copy is None:
+            self.server.discard(key, template)
+            return None
+        copy.memo = template.memo
+        return copy
+
+    def close(self):
+        self.server.close()
+
+
+class Memo(OrderedDict):
+    """Memoized results, the oldest are dropped when there are more than max_size"""
+
+    def __init__(self, max_size):
+        super().__init__()
+        self.max_size = max_size
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        while len(self) > self.max_size:
+            self.popitem(last=False)
+
+
 class ChDir(object):
     """
     Step into a directory temporarily.
@@ -142,57 +1175,345 @@ class ChDir(object):
         os.chdir(self.old_dir)
 
 
-def run_code(executor, code):
-    with io.StringIO() as output:
-        try:
-            with redirect_stdout(output):
-                executor(code)
-            raw_output = output.getvalue()
-            error = None
-        except BaseException as e:
-            raw_output = ""
-            error = str(e)
+class CapturedOutput(str):
+    """
+    Output of a run, with a marker in place of the part that was dropped, if any.
+
+    ``parts`` are the parts of the output that were kept, to search them
+    without matching the marker or text around it.
+    """
+
+    marker = "\n... [{} characters of output dropped] ...\n"
+
+    def __new__(cls, parts, dropped=0):
+        output = super().__new__(cls, cls.marker.format(dropped).join(parts))
+        output.parts = parts
+        output.dropped = dropped
+        return output
+
+    def __reduce__(self):
+        return CapturedOutput, (self.parts, self.dropped)
+
+    def strip(self, chars=None):
+        """Strip the start of the first part and the end of the last part"""
+        parts = list(self.parts)
+        parts[0] = parts[0].lstrip(chars)
+        parts[-1] = parts[-1].rstrip(chars)
+        return CapturedOutput(parts, self.dropped)
+
+
+class BoundedOutput(io.TextIOBase):
+    """Text stream that keeps the start and the end of the text written to it
+
+    At most ``limit`` characters are kept, the first half of them at the start
+    and the rest at the end. With ``limit`` None, all text is kept.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.head = []
+        self.head_room = limit // 2 if limit else None
+        self.tail = deque()
+        self.tail_size = 0
+        self.tail_limit = limit - limit // 2 if limit else None
+        self.written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.written += len(text)
+        if self.limit is None:
+            self.head.append(text)
+            return len(text)
+
+        if self.head_room > 0:
+            self.head.append(text[: self.head_room])
+            rest = text[self.head_room :]
+            self.head_room -= len(text) - len(rest)
+        else:
+            rest = text
+
+        if rest:
+            self.tail.append(rest)
+            self.tail_size += len(rest)
+            while self.tail_size > self.tail_limit:
+                excess = self.tail_size - self.tail_limit
+                if len(self.tail[0]) <= excess:
+                    self.tail_size -= len(self.tail.popleft())
+                else:
+                    self.tail[0] = self.tail[0][excess:]
+                    self.tail_size -= excess
+        return len(text)
+
+    def getvalue(self):
+        head, tail = "".join(self.head), "".join(self.tail)
+        dropped = self.written - len(head) - len(tail)
+        if dropped:
+            return CapturedOutput([head, tail], dropped)
+        return CapturedOutput([head + tail])
+
+
+def run_code(executor, code, limit=None):
+    output = BoundedOutput(limit)
+    try:
+        with redirect_stdout(output):
+            executor(code)
+        raw_output = output.getvalue()
+        error = None
+    except BaseException as e:
+        raw_output = ""
+        error = str(e)
     return raw_output, error
 
 
-def run_single_process(pec, code, pid=None, mode="simple"):
+class PendingRun:
+    """
+    Code submitted to a process, of which the results are not in yet.
+
+    ``results`` is the number of results to wait for, ``unpack`` turns them into
+    the raw output and error of the code. The run can be waited for with ``wait()``
+    (or by calling it), or awaited with ``wait_async()``.
+    """
+
+    def __init__(self, process, results=0, unpack=lambda answers: (None, None)):
+        self.process = process
+        self.results = results
+        self.unpack = unpack
+        self.cache = None
+
+    def wait(self):
+        answers = [self.process.getResult() for _ in range(self.results)]
+        return self.finish(answers)
+
+    __call__ = wait
+
+    async def wait_async(self):
+        answers = [await self.process.getResultAsync() for _ in range(self.results)]
+        if self.cache is None:
+            return self.finish(answers)
+        # caching the solution forks a copy of it, which waits for the copy
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.finish, answers)
+
+    def finish(self, answers):
+        raw_output, error = self.unpack(answers)
+        if self.cache is not None:
+            solution_cache, key = self.cache
+            self.process = solution_cache.add(key, self.process)
+            self.cache = None
+        return self.process, raw_output, error
+
+
+def unpack_full_output(answers):
+    output, raw_output = answers[-1]
+    raw_output = raw_output["output_stream"]
+    error = raw_output["error"]
+    return raw_output, error
+
+
+def start_single_process(
+    pec, code, pid=None, mode="simple", pool=None, wd=None, server=None, role="student",
+):
+    """Start running the PEC and code, return the ``PendingRun`` to wait for the result
+
+    The code runs in ``wd``, or the current working directory if it is not set.
+    Processes are moved into it themselves, so the working directory of this process
+    doesn't change and several runs can be in progress at the same time.
+    ``role`` is the student or solution, pools that reuse processes keep them apart.
+    """
+    wd = os.path.abspath(str(wd or os.getcwd()))
+
     if mode == "stub":
         # no isolation
-        process = StubProcess(init_code=pec, pid=pid)
-        raw_output, error = run_code(process.shell.run_code, code)
+        with ChDir(wd):
+            process = StubProcess(init_code=pec, pid=pid)
+            raw_output, error = run_code(process.shell.run_code, code)
+        return PendingRun(process, unpack=lambda answers: (raw_output, error))
 
     elif mode == "simple":
         # no advanced functionality
-        process = SimpleProcess(pid)
-        process.start()
-        _ = process.executeTask(TaskCaptureOutput(pec))
-        raw_output, error = process.executeTask(TaskCaptureOutput(code))
+        pool = get_pool(SimpleProcess, pool)
+        if pool is not None and pool.reuse:
+            # the PEC already ran in the template the process was forked from
+            process = pool.acquire(pid, (pec, wd, role))
+            tasks = []
+        else:
+            process = start_process(SimpleProcess, pid, pool)
+            tasks = [TaskChDir(wd), TaskCaptureOutput(pec)]
+        for task in tasks + [TaskCaptureOutput(code)]:
+            process.submitTask(task)
+        return PendingRun(process, len(tasks) + 1, lambda answers: answers[-1])
+
+    elif mode == "fork":
+        # the PEC already ran in the process that is forked
+        process = (server or ForkServer.get_default()).fork(pec, wd, pid)
+        process.submitTask(TaskCaptureOutput(code))
+        return PendingRun(process, 1, lambda answers: answers[-1])
 
     elif mode == "full" and BACKEND_AVAILABLE:
         # slow
-        process = WorkerProcess(pid)
-        process.start()
-        _ = process.executeTask(
-            TaskCaptureFullOutput((pec,), "<PEC>", None, silent=True)
-        )
-        output, raw_output = process.executeTask(
+        process = start_process(WorkerProcess, pid, pool)
+        process.submitTask(TaskChDir(wd))
+        process.submitTask(TaskCaptureFullOutput((pec,), "<PEC>", None, silent=True))
+        process.submitTask(
             TaskCaptureFullOutput((code,), "script.py", None, silent=True)
         )
-        raw_output = raw_output["output_stream"]
-        error = raw_output["error"]
+        return PendingRun(process, 3, unpack_full_output)
 
     else:
         raise ValueError("Invalid mode")
 
-    return process, raw_output, error
 
+def run_single_process(
+    pec, code, pid=None, mode="simple", pool=None, wd=None, server=None, role="student"
+):
+    return start_single_process(pec, code, pid, mode, pool, wd, server, role).wait()
+
+
+class LazyRun:
+    """
+    Code that only starts running when its process, output or error is used.
+
+    ``start`` is called to start the run, it returns a ``PendingRun``.
+    Waiting for a lazy run returns stand-ins for its process, output and error.
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.result = None
+
+    @property
+    def started(self):
+        return self.result is not None
+
+    def get(self):
+        if self.result is None:
+            self.result = self.start().wait()
+        return self.result
+
+    def wait(self):
+        return LazyProcess(self), LazyOutput(self), LazyErrors(self)
+
+    __call__ = wait
+
+    async def wait_async(self):
+        return self.wait()
 
-def run_exercise(pec, sol_code, stu_code, sol_wd=None, stu_wd=None, **kwargs):
-    with ChDir(sol_wd or os.getcwd()):
-        sol_process, _, _ = run_single_process(pec, sol_code, **kwargs)
 
-    with ChDir(stu_wd or os.getcwd()):
-        stu_process, raw_stu_output, error = run_single_process(pec, stu_code, **kwargs)
+class LazyProcess:
+    """Stand-in for the process of a LazyRun, it starts the run when it is used"""
+
+    def __init__(self, run):
+        self.run = run
+        self._identity = (random.randint(0, 1e12),)
+
+    def __getattr__(self, name):
+        if name == "run":  # not set yet, e.g. while copying
+            raise AttributeError(name)
+        # executeTask, submitTask, getResult, memo, ...
+        return getattr(self.run.get()[0], name)
+
+    def is_alive(self):
+        return not self.run.started or self.run.get()[0].is_alive()
+
+    def kill(self):
+        if self.run.started:
+            self.run.get()[0].kill()
+
+
+class LazyOutput:
+    """Stand-in for the output of a LazyRun, ``get()`` starts the run"""
+
+    def __init__(self, run):
+        self.run = run
+
+    def get(self):
+        return self.run.get()[1]
+
+
+class LazyErrors(Sequence):
+    """Errors of a LazyRun, the run starts when they are looked at"""
+
+    def __init__(self, run):
+        self.run = run
+
+    def errors(self):
+        error = self.run.get()[2]
+        return [error] if error else []
+
+    def __getitem__(self, i):
+        return self.errors()[i]
+
+    def __len__(self):
+        return len(self.errors())
+
+
+def start_exercise(
+    pec,
+    sol_code,
+    stu_code,
+    sol_wd=None,
+    stu_wd=None,
+    solution_cache=None,
+    needed=("solution", "student"),
+    **kwargs
+):
+    """Start running the solution and student code, return their ``PendingRun``s
+
+    Both are started before waiting for either, so they run at the same time.
+    Code of which the process isn't in ``needed`` gets a ``LazyRun``,
+    so it only runs when it turns out to be needed after all.
+    """
+    sol_wd = os.path.abspath(str(sol_wd or os.getcwd()))
+    stu_wd = os.path.abspath(str(stu_wd or os.getcwd()))
+    solution_cache = solution_cache or SolutionCache.default
+    sol_run = None
+    if solution_cache is not None:
+        key = solution_cache.get_key(pec, sol_code, sol_wd)
+        sol_process = solution_cache.get(key)
+        if sol_process is not None:
+            sol_run = PendingRun(sol_process)
+
+    def start_solution():
+        run = start_single_process(pec, sol_code, wd=sol_wd, role="solution", **kwargs)
+        if solution_cache is not None:
+            run.cache = (solution_cache, key)
+        return run
+
+    def start_student():
+        return start_single_process(pec, stu_code, wd=stu_wd, **kwargs)
+
+    if sol_run is None:
+        if "solution" in needed:
+            sol_run = start_solution()
+        else:
+            sol_run = LazyRun(start_solution)
+    if "student" in needed:
+        stu_run = start_student()
+    else:
+        stu_run = LazyRun(start_student)
+    return sol_run, stu_run
+
+
+def run_exercise(pec, sol_code, stu_code, **kwargs):
+    sol_run, stu_run = start_exercise(pec, sol_code, stu_code, **kwargs)
+    sol_process, _, _ = sol_run.wait()
+    stu_process, raw_stu_output, error = stu_run.wait()
+
+    return sol_process, stu_process, raw_stu_output, error
+
+
+async def async_run_exercise(pec, sol_code, stu_code, **kwargs):
+    """Like ``run_exercise``, but the event loop keeps running while the code runs"""
+    # starting can run the PEC in a template and wait for forked copies to connect
+    loop = asyncio.get_running_loop()
+    sol_run, stu_run = await loop.run_in_executor(
+        None, partial(start_exercise, pec, sol_code, stu_code, **kwargs)
+    )
+    (sol_process, _, _), (stu_process, raw_stu_output, error) = await asyncio.gather(
+        sol_run.wait_async(), stu_run.wait_async()
+    )
 
     return sol_process, stu_process, raw_stu_output, error
 
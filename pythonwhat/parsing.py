@@ -1,4 +1,5 @@
 import ast
+import copy
 from pythonwhat.utils_ast import wrap_in_module
 from collections.abc import Sequence, Mapping
 from collections import OrderedDict
@@ -760,6 +761,16 @@ class DictCompParser(CompParser):
 
 class FunctionBodyTransformer(ast.NodeTransformer):
     # TODO this does not automatically contain line_end information!
+    def generic_visit(self, node):
+        # transform copies, parsed trees are shared (see State.ParseCache)
+        node, source = copy.copy(node), node
+        # the tokens of the copy are those of the node (see State.CodeTokens.mark)
+        node.token_source = source
+        for field, value in ast.iter_fields(node):
+            if isinstance(value, list):
+                setattr(node, field, list(value))
+        return super().generic_visit(node)
+
     def visit_Nonlocal(self, node):
         new_node = ast.copy_location(ast.Global(names=node.names), node)
         return FunctionBodyTransformer.decorate(new_node, node)
@@ -770,8 +781,7 @@ class FunctionBodyTransformer(ast.NodeTransformer):
 
     @staticmethod
     def decorate(new_node, node):
-        new_node.first_token = node.first_token
-        new_node.last_token = node.last_token
+        new_node.token_source = node
         return new_node
 
 
@@ -866,3 +876,59 @@ parser_dict = {
     "try_excepts": TryExceptParser,
     "function_calls": FunctionParser,
 }
+
+
+class TreeIndex:
+    """Outputs of all parsers in parser_dict for a tree, built in a single pass.
+
+    The statements at the top of the tree are visited once, and each of them is only
+    handed to the parsers that visit its type, as the others ignore it. Below that,
+    every parser keeps its own rules for going deeper.
+    The pass is made when an output is first needed. The parsers for function calls
+    and object accesses start from the name mappings of the PEC (``mappings``).
+    """
+
+    def __init__(self, tree, mappings=None):
+        self.tree = tree
+        self.mappings = mappings or {}
+        self.parsers = None
+
+    def get(self, key):
+        """Get the output of a parser in parser_dict, or its name mappings
+
+        ``mappings`` and ``oa_mappings`` are the mappings of the parsers for
+        function calls and object accesses.
+        """
+        if self.parsers is None:
+            self.parsers = self.build()
+        if key == "mappings":
+            return self.parsers["function_calls"].mappings
+        if key == "oa_mappings":
+            return self.parsers["object_accesses"].mappings
+        return self.parsers[key].out
+
+    def build(self):
+        parsers = {key: Parser() for key, Parser in parser_dict.items()}
+        for key in ["function_calls", "object_accesses"]:
+            parsers[key].mappings = self.mappings.copy()
+
+        visitors = {}
+        for node in self.top_level(self.tree):
+            method = "visit_" + node.__class__.__name__
+            if method not in visitors:
+                visitors[method] = [
+                    getattr(p, method) for p in parsers.values() if hasattr(p, method)
+                ]
+            for visit in visitors[method]:
+                visit(node)
+
+        return parsers
+
+    @staticmethod
+    def top_level(tree):
+        # the nodes Parser.visit_Module and Parser.visit_Expression visit
+        if isinstance(tree, ast.Module):
+            return tree.body
+        if isinstance(tree, ast.Expression):
+            return [tree.body]
+        return [tree]
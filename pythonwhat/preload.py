@@ -0,0 +1,77 @@
+import ast
+import json
+from collections import OrderedDict
+
+from pythonwhat.parsing import ImportParser
+
+
+def imported_modules(*codes):
+    """
+    Find the modules that code imports at the top level, to preload them.
+
+    Names imported with ``from module import name`` are listed as ``module.name``,
+    as ``name`` can be a module too. ``local.preload_modules`` imports what it can.
+    Code that can't be parsed is skipped, it fails when it runs.
+    """
+    modules = OrderedDict()
+    for code in codes:
+        parser = ImportParser()
+        try:
+            parser.visit(ast.parse(code or ""))
+        except (SyntaxError, TypeError):  # TypeError for relative imports
+            continue
+        modules.update(parser.out)
+    return tuple(modules)
+
+
+class PreloadManifest:
+    """
+    Modules imported by the PEC and solution of every exercise in a set.
+
+    Pools and fork servers can preload the modules of all exercises, or be
+    specialized for some of them:
+
+        manifest = PreloadManifest.from_exercises(exercises)
+        pool = WorkerPool(preload=manifest.modules("ex_1", "ex_2"))
+
+    The manifest can be saved as JSON, so it only has to be built when the
+    exercises change.
+    """
+
+    def __init__(self, exercises=None):
+        self.exercises = OrderedDict()
+        for key, modules in (exercises or {}).items():
+            self.exercises[key] = tuple(modules)
+
+    @classmethod
+    def from_exercises(cls, exercises):
+        """Build a manifest from a dict of exercises, see ``add``"""
+        manifest = cls()
+        for key, exercise in exercises.items():
+            manifest.add(
+                key,
+                exercise.get("pre_exercise_code", ""),
+                exercise.get("solution_code", ""),
+            )
+        return manifest
+
+    def add(self, key, pre_exercise_code="", solution_code=""):
+        modules = imported_modules(pre_exercise_code, solution_code)
+        self.exercises[key] = modules
+        return modules
+
+    def modules(self, *keys):
+        """The modules to preload for the exercises with keys, or for all exercises"""
+        modules = OrderedDict()
+        for key in keys or self.exercises:
+            modules.update(dict.fromkeys(self.exercises[key]))
+        return tuple(modules)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.exercises, f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f, object_pairs_hook=OrderedDict))
@@ -4,9 +4,16 @@ import pickle
 import pythonwhat
 import ast
 import inspect
+import itertools
+import os
+import sys
+import hashlib
+import weakref
 from copy import deepcopy
 from pickle import PicklingError
+from pythonwhat.utils_ast import mutated_names
 from pythonwhat.utils_env import set_context_vals, assign_from_ast
+from pythonwhat.local import BoundedOutput, LimitExceeded, TaskBatch, TaskIsolated
 from contextlib import contextmanager
 from functools import partial, wraps
 from protowhat.failure import InstructorError
@@ -17,9 +24,20 @@ from protowhat.failure import InstructorError
 
 
 def process_task(f):
-    """Decorator to (optionally) run function in a process."""
+    """Decorator to (optionally) run function in a process.
+
+    The decorated function gets a ``task`` attribute, that returns the task
+    a call would execute in its process, so it can be batched with ``execute_tasks``.
+    """
     sig = inspect.signature(f)
 
+    def make_task(*args, **kwargs):
+        ba = sig.bind_partial(*args, **kwargs)
+        ba.arguments["process"] = None
+        # partial function since shell argument may have been left
+        # unspecified, as it will be passed when the process executes
+        return partial(wrapper, *ba.args, **ba.kwargs)
+
     @wraps(f)
     def wrapper(*args, **kwargs):
         # get bound arguments for call
@@ -27,17 +45,26 @@ def process_task(f):
         # when process is specified, remove from args and use to execute
         process = ba.arguments.get("process")
         if process:
-            ba.arguments["process"] = None
-            # partial function since shell argument may have been left
-            # unspecified, as it will be passed when the process executes
-            pf = partial(wrapper, *ba.args, **ba.kwargs)
-            return process.executeTask(pf)
+            return process.executeTask(make_task(*args, **kwargs))
         # otherwise, run original function
         return f(*ba.args, **ba.kwargs)
 
+    wrapper.task = make_task
     return wrapper
 
 
+def execute_tasks(process, tasks):
+    """Execute several tasks in a process in a single round trip, return their results"""
+    results = process.executeTask(TaskBatch(tasks))
+    if isinstance(results, tuple):
+        return list(results)
+    if isinstance(results, LimitExceeded):
+        # the process gave up on the batch as a whole
+        return [results] * len(tasks)
+    # the batch itself failed (e.g. couldn't be sent), execute tasks one by one
+    return [process.executeTask(task) for task in tasks]
+
+
 def get_env(ns):
     if "__env__" in ns:
         return ns["__env__"]
@@ -48,10 +75,10 @@ def get_env(ns):
 @contextmanager
 def capture_output():
     import sys
-    from io import StringIO
 
     oldout, olderr = sys.stdout, sys.stderr
-    out = [StringIO(), StringIO()]
+    limit = pythonwhat.local.OUTPUT_LIMIT
+    out = [BoundedOutput(limit), BoundedOutput(limit)]
     sys.stdout, sys.stderr = out
     yield out
     sys.stdout, sys.stderr = oldout, olderr
@@ -178,8 +205,134 @@ def context_env_update(context_list, env):
     return es
 
 
+missing = object()
+
+
+class RepresentationCache:
+    """Results of memoized tasks (see memoize) during a grading, with hit counts"""
+
+    def __init__(self):
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, memo, key, compute):
+        # a single lookup, memos of cached solutions are shared by concurrent gradings
+        result = memo.get(key, missing)
+        if result is not missing:
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = compute()
+        if not failed(result):
+            memo[key] = result
+        return result
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.results)}
+
+
+def failed(result):
+    """Whether (part of) a result is a limit that was exceeded or a backend error
+
+    These can be different the next time, e.g. when the process was killed,
+    so they aren't memoized.
+    """
+    parts = result if isinstance(result, tuple) else (result,)
+    return any(
+        isinstance(part, LimitExceeded) or isinstance(part, list) and errored(part)
+        for part in parts
+    )
+
+
+# unique numbers for the namespaces of processes, see new_generation
+generations = itertools.count(1)
+
+
+def new_generation(process):
+    """Invalidate the memoized results of the current namespace of process
+
+    ``process.generations`` is a stack with the generation of the namespace of
+    the process, and of every environment set up in it (see track_env).
+    """
+    stack = getattr(process, "generations", None) or [0]
+    stack[-1] = next(generations)
+    process.generations = stack
+
+
+def memoize(f):
+    """Reuse results of f per process and generation of its namespace
+
+    Results are memoized per set of arguments and manual converters, in the
+    RepresentationCache of the root state, or across gradings in processes
+    that keep a memo (see local.SolutionCache).
+    Evaluations without copying the environment may change the namespace,
+    so they aren't memoized and start a new generation. Neither are ``failed``
+    results.
+    """
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        process = kwargs.get("process")
+        state = getattr(pythonwhat.State.State, "root_state", None)
+        if process is None or state is None:
+            return f(*args, **kwargs)
+        if not kwargs.get("copy", True):
+            try:
+                return f(*args, **kwargs)
+            finally:
+                new_generation(process)
+
+        stack = getattr(process, "generations", None) or [0]
+        # results in set up environments are only kept during the grading
+        memo = getattr(process, "memo", None)
+        if memo is None or len(stack) > 1:
+            memo = state.representations.results
+
+        try:
+            key = (
+                f,
+                process._identity[0],
+                stack[-1],
+                pickle.dumps(
+                    (args, {k: v for k, v in kwargs.items() if k != "process"})
+                ),
+                tuple(
+                    (k, getattr(v, "__code__", id(v)))
+                    for k, v in sorted(state.converters.items())
+                ),
+            )
+        except Exception:
+            return f(*args, **kwargs)
+
+        return state.representations.get(memo, key, partial(f, *args, **kwargs))
+
+    return wrapper
+
+
+def track_env(f, depth):
+    """Track the environments set up (depth 1) and broken down (-1) in a process by f
+
+    Every environment gets its own generation, see new_generation.
+    """
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        process = kwargs.get("process")
+        if process is not None:
+            stack = getattr(process, "generations", None) or [0]
+            if depth > 0:
+                stack.append(next(generations))
+            elif len(stack) > 1:
+                stack.pop()
+            process.generations = stack
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
 @process_task
-def setUpNewEnvInProcess(context, process, shell):
+def setUpNewEnv(context, process, shell):
     shell.user_ns["__env__"] = utils.copy_env(shell.user_ns)
     try:
         es = context_env_update(context, shell.user_ns["__env__"])
@@ -199,7 +352,7 @@ def context_objs_exit(es):
 
 
 @process_task
-def breakDownNewEnvInProcess(process, shell):
+def breakDownNewEnv(process, shell):
     try:
         res = context_objs_exit(shell.user_ns["__exit_stack__"])
         del shell.user_ns["__exit_stack__"]
@@ -209,6 +362,10 @@ def breakDownNewEnvInProcess(process, shell):
         return False
 
 
+setUpNewEnvInProcess = track_env(setUpNewEnv, 1)
+breakDownNewEnvInProcess = track_env(breakDownNewEnv, -1)
+
+
 # Tasks that may need to serialize across processes ===========================
 
 # Get a bytes or string representation of an object in the process
@@ -227,10 +384,114 @@ def convert(name, converter, process, shell):
     return dill.loads(converter)(get_env(shell.user_ns)[name])
 
 
+# buffers (e.g. of numpy arrays) at least this large are moved through shared memory
+SHARED_MEMORY_THRESHOLD = 1024 ** 2
+
+
+class SharedMemoryStream:
+    """Pickle stream with its out-of-band buffers stored in a shared memory block.
+
+    The block is created in the process and unlinked by the grader when loading,
+    so large arrays don't have to be sent through the result pipe. A stream that
+    is dropped by the grader without loading it unlinks the block.
+    """
+
+    def __init__(self, data, name, sizes, received=False):
+        self.data = data
+        self.name = name
+        self.sizes = sizes
+        # whether the stream was sent here, and if so, if it's still owned here
+        self.received = received
+
+    def __reduce__(self):
+        # a received stream that is passed on (see local.TaskIsolated) is owned
+        # by the process it is sent to
+        self.received = False
+        return SharedMemoryStream, (self.data, self.name, self.sizes, True)
+
+    def __del__(self):
+        if self.received:
+            self.unlink()
+
+    def loads(self):
+        from multiprocessing import shared_memory
+
+        self.received = False
+        shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            buffer = memoryview(bytearray(shm.buf[: sum(self.sizes)]))
+        finally:
+            shm.close()
+            shm.unlink()
+        buffers = []
+        offset = 0
+        for size in self.sizes:
+            buffers.append(buffer[offset : offset + size])
+            offset += size
+        return pickle.loads(self.data, buffers=buffers)
+
+    def unlink(self):
+        from multiprocessing import shared_memory
+
+        self.received = False
+        try:
+            shm = shared_memory.SharedMemory(name=self.name)
+        except OSError:
+            return
+        shm.close()
+        shm.unlink()
+
+
+def dumps_shared(obj):
+    """Pickle obj, moving its large buffers into shared memory when possible"""
+    if os.name != "posix" or pickle.HIGHEST_PROTOCOL < 5:
+        # shared memory is freed on Windows when the process closes its handle,
+        # out-of-band buffers need Python 3.8
+        return pickle.dumps(obj)
+    from multiprocessing import resource_tracker, shared_memory
+
+    buffers = []
+
+    def buffer_callback(buffer):
+        # a true return value keeps the buffer in the pickle stream
+        if buffer.raw().nbytes < SHARED_MEMORY_THRESHOLD:
+            return True
+        buffers.append(buffer.raw())
+
+    data = pickle.dumps(obj, protocol=5, buffer_callback=buffer_callback)
+    if not buffers:
+        return data
+
+    sizes = [buffer.nbytes for buffer in buffers]
+    shm = shared_memory.SharedMemory(create=True, size=sum(sizes))
+    offset = 0
+    for buffer, size in zip(buffers, sizes):
+        shm.buf[offset : offset + size] = buffer
+        offset += size
+    shm.close()
+    # the grader takes ownership of the block, and unlinks it after loading
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return SharedMemoryStream(data, shm.name, sizes)
+
+
+def loads_shared(stream):
+    if isinstance(stream, SharedMemoryStream):
+        return stream.loads()
+    return pickle.loads(stream)
+
+
 @process_task
 def getStreamPickle(name, process, shell):
     try:
-        return pickle.dumps(get_env(shell.user_ns)[name])
+        obj = get_env(shell.user_ns)[name]
+    except:
+        return None
+    try:
+        return dumps_shared(obj)
+    except:
+        pass
+    try:
+        return pickle.dumps(obj)
     except:
         return None
 
@@ -248,42 +509,199 @@ class ReprFail:
         self.info = info
 
 
-def getRepresentation(name, process):
-    obj_class = getClass(name, process)
-    converters = pythonwhat.State.State.root_state.converters
-    if obj_class in converters:
-        repres = convert(name, dill.dumps(converters[obj_class]), process)
-        if errored(repres):
-            return ReprFail("manual conversion failed: {}".format(repres))
+# dill streams of the manual converters, so they are only dilled once
+dilled_converters = weakref.WeakKeyDictionary()
+
+
+def dill_converters(converters):
+    dilled = {}
+    for obj_class, converter in converters.items():
+        try:
+            if converter not in dilled_converters:
+                dilled_converters[converter] = dill.dumps(converter)
+            dilled[obj_class] = dilled_converters[converter]
+        except TypeError:  # e.g. builtins can't be weakly referenced
+            dilled[obj_class] = dill.dumps(converter)
+    return dilled
+
+
+def content_digest(obj):
+    """Digest of the type and content of obj, None if it can't be computed
+
+    Equal digests mean the objects are equal, the other way around isn't guaranteed:
+    e.g. 1 and 1.0 have different digests. Floats that are nan have no digest,
+    as they are never equal to themselves, but nan in arrays and frames have one.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    try:
+        update_digest(digest, obj)
+    except Exception:
+        return None
+    return digest.hexdigest()
+
+
+def update_digest(digest, obj):
+    obj_type = type(obj)
+    digest.update(("%s.%s\0" % (obj_type.__module__, obj_type.__qualname__)).encode())
+    pd = sys.modules.get("pandas")  # pandas objects are only created if it's imported
+    np = sys.modules.get("numpy")
+
+    if obj_type is float and obj != obj:
+        raise ValueError("nan isn't equal to itself")
+    if obj is None or obj_type in (bool, int, float, complex, str, bytes):
+        digest.update(repr(obj).encode())
+    elif obj_type in (list, tuple):
+        digest.update(b"%d\0" % len(obj))
+        for item in obj:
+            update_digest(digest, item)
+    elif obj_type in (dict, set, frozenset):
+        # the order of the items doesn't matter, so the digests of the items are sorted
+        items = obj.items() if obj_type is dict else ((item,) for item in obj)
+        for item in sorted(content_digest(item) or "" for item in items):
+            if not item:
+                raise ValueError("no digest for an item")
+            digest.update(item.encode())
+    elif np is not None and obj_type is np.ndarray:
+        digest.update(("%s%r\0" % (obj.dtype.str, obj.shape)).encode())
+        if obj.dtype.hasobject:
+            update_digest(digest, obj.tolist())
+        else:
+            digest.update(np.ascontiguousarray(obj).tobytes())
+    elif pd is not None and obj_type in (pd.DataFrame, pd.Series):
+        if obj_type is pd.DataFrame:
+            update_digest(digest, [str(dtype) for dtype in obj.dtypes])
+            update_digest(digest, list(obj.columns))
         else:
-            return repres
+            update_digest(digest, [str(obj.dtype), obj.name])
+        update_digest(digest, [str(obj.index.dtype), list(obj.index.names)])
+        hashes = pd.util.hash_pandas_object(obj, index=True)
+        digest.update(hashes.values.tobytes())
     else:
-        # first try to pickle
+        raise TypeError("no digest for %s" % obj_type)
+
+
+def grader_importable(module_name):
+    """Whether the grader can import the module, to pickle its classes by reference
+
+    Modules created at runtime (without a spec, e.g. ``__main__``) or imported
+    from the working directory, e.g. by the pre exercise code, aren't available there.
+    """
+    module = sys.modules.get(module_name)
+    if module is None or getattr(module, "__spec__", None) is None:
+        return False
+    path = getattr(module, "__file__", None)
+    if path is None:  # e.g. builtin modules
+        return True
+    return not os.path.realpath(path).startswith(os.path.realpath(os.getcwd()) + os.sep)
+
+
+@process_task
+def getValue(name, converters, process, shell, digest=False):
+    """Get the class of an object and its value, serialized as cheaply as possible
+
+    The object is converted if there is a manual converter for its class,
+    pickled if possible and dilled otherwise. Returns a tuple of the class,
+    the serializer used (convert, pickle, dill or None if none worked), the value
+    and a dill stream to fall back on if the grader can't unpickle the value,
+    for ``loadValue`` to load, so the value is extracted in a single round trip.
+    The fallback is only dilled if the class isn't importable in the grader.
+    With ``digest``, the value is the content digest of the (converted) object
+    instead, see ``content_digest``.
+    """
+    try:
+        obj = get_env(shell.user_ns)[name]
+    except:
+        return None, None, None, None
+    obj_type = type(obj)
+    obj_class = obj_type.__module__ + "." + obj_type.__name__
+
+    if obj_class in converters:
         try:
-            stream = getStreamPickle(name, process)
-            if not errored(stream):
-                return pickle.loads(stream)
+            value = dill.loads(converters[obj_class])(obj)
+        except Exception as e:
+            value = [{"type": "backend-error", "payload": str(e)}]
+        if errored(value):
+            value = ReprFail("manual conversion failed: {}".format(value))
+        elif digest:
+            value = content_digest(value)
+        return obj_class, "convert", value, None
+
+    if digest:
+        return obj_class, "convert", content_digest(obj), None
+
+    for dumps in (dumps_shared, pickle.dumps):
+        try:
+            value = dumps(obj)
         except:
-            pass
+            continue
+        fallback = None
+        if not grader_importable(obj_type.__module__):
+            try:
+                fallback = dill.dumps(obj)
+            except:
+                pass
+        return obj_class, "pickle", value, fallback
+    try:
+        return obj_class, "dill", dill.dumps(obj), None
+    except:
+        return obj_class, None, None, None
 
-        # if it failed, try to dill
+
+@process_task
+def extractResult(task, name, converters, process, shell, digest=False):
+    """Run a task that stores its result as name, and get the value (see getValue)
+
+    Failed results are returned as is, e.g. for run_task to handle memory errors.
+    With ``digest``, the string representation of the result isn't sent either.
+    """
+    res = task(shell)
+    if isinstance(res, (UndefinedValue, Exception)):
+        return res
+    value = getValue(name, converters, process=None, shell=shell, digest=digest)
+    return None if digest else res, value
+
+
+def loadValue(extracted):
+    """Load a value extracted by getValue, a ReprFail if that isn't possible"""
+    if not isinstance(extracted, tuple):  # backend error
+        extracted = None, None, None, None
+    obj_class, serializer, value, fallback = extracted
+
+    if serializer == "convert":
+        return value
+
+    if serializer == "pickle":
         try:
-            stream = getStreamDill(name, process)
-            if not errored(stream):
-                return dill.loads(stream)
-            return ReprFail(
-                "dilling inside process failed for %s - write manual converter"
-                % obj_class
-            )
-        except PicklingError:
-            return ReprFail(
-                "undilling of bytestream failed with PicklingError - write manual converter"
-            )
+            return loads_shared(value)
         except Exception as e:
-            return ReprFail(
-                "undilling of bytestream failed for class %s - write manual converter."
-                "Error: %s - %s" % (obj_class, type(e), e)
-            )
+            # e.g. the class isn't available here, try the dill stream instead
+            if fallback is None:
+                return ReprFail(
+                    "unpickling failed for class %s - write manual converter."
+                    "Error: %s - %s" % (obj_class, type(e), e)
+                )
+            value = fallback
+
+    if serializer is None:
+        return ReprFail(
+            "dilling inside process failed for %s - write manual converter" % obj_class
+        )
+    try:
+        return dill.loads(value)
+    except PicklingError:
+        return ReprFail(
+            "undilling of bytestream failed with PicklingError - write manual converter"
+        )
+    except Exception as e:
+        return ReprFail(
+            "undilling of bytestream failed for class %s - write manual converter."
+            "Error: %s - %s" % (obj_class, type(e), e)
+        )
+
+
+def getRepresentation(name, process):
+    converters = pythonwhat.State.State.root_state.converters
+    return loadValue(getValue(name, dill_converters(converters), process))
 
 
 def errored(el):
@@ -295,17 +713,24 @@ class UndefinedValue:
     pass
 
 
-def getResultFromProcess(res, tempname, process):
-    """Get a value from process, return tuple of value, res if succesful"""
+def getResultFromProcess(res, tempname, process, extracted=None):
+    """Get a value from process, return tuple of value, res if succesful
+
+    ``extracted`` is the result of getValue, if it already ran with the task.
+    """
     if not isinstance(res, (UndefinedValue, Exception)):
-        value = getRepresentation(tempname, process)
+        if extracted is None:
+            value = getRepresentation(tempname, process)
+        else:
+            value = loadValue(extracted)
         return value, res
     else:
         return res, str(res)
 
 
 # decorator to automatically get value after running process task function
-def get_rep(f):
+# with digest, the value is the content digest of the result (see content_digest)
+def get_rep(f, digest=False):
     sig = inspect.signature(f)
 
     @wraps(f)
@@ -316,10 +741,47 @@ def get_rep(f):
         # get tempname, process arg values
         tempname = ba.arguments["tempname"]
         process = ba.arguments["process"]
-        # run process task
-        res = f(*args, **kwargs)
-        # get result from task
-        return getResultFromProcess(res, tempname, process)
+        # run process task and extract its result in one round trip
+        converters = dill_converters(pythonwhat.State.State.root_state.converters)
+        ba.arguments["copy"] = copy = resolve_copy(ba.arguments["copy"])
+        task = extractResult.task(
+            f.task(*ba.args, **ba.kwargs), tempname, converters, digest=digest
+        )
+        result = execute_isolated(process, task, copy)
+        if isinstance(result, tuple):
+            res, extracted = result
+        else:  # the task failed, or a limit was exceeded
+            res, extracted = result, None
+        return getResultFromProcess(res, tempname, process, extracted)
+
+    return wrapper
+
+
+# How evaluations that copy (copy=True) keep the namespace of the process intact:
+# "copy" deep copies the environment, "fork" evaluates in a forked child of the
+# process (local.TaskIsolated), which doesn't have to copy anything
+ISOLATION = os.environ.get("PYTHONWHAT_ISOLATION", "copy")
+
+
+def resolve_copy(copy):
+    return "fork" if copy is True and ISOLATION == "fork" else copy
+
+
+def execute_isolated(process, task, copy):
+    """Execute task in process, in a forked child of the process if copy is "fork" """
+    if copy == "fork":
+        task = TaskIsolated(task)
+    return process.executeTask(task)
+
+
+def isolate(f, *f_args):
+    """Run the process task f (after f_args) isolated as its copy argument asks"""
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        kwargs["copy"] = resolve_copy(kwargs.get("copy", True))
+        task = f.task(*f_args, *args, **kwargs)
+        return execute_isolated(kwargs["process"], task, kwargs["copy"])
 
     return wrapper
 
@@ -420,15 +882,26 @@ def taskRunEval(
         # Avoid a deep copy if specified or if the ast node type indicates we are looking up a variable by name
         # ast.Name, ast.Subscript and ast.Load most of the time do not have side effects in the environment,
         #   making a deepcopy unnecessary
-        if not copy or (
-            isinstance(tree, (ast.Name, ast.Subscript))
-            and isinstance(tree.ctx, ast.Load)
+        # In a forked child (copy="fork"), side effects are discarded with the child
+        if (
+            not copy
+            or (copy == "fork" and pythonwhat.local.isolated)
+            or (
+                isinstance(tree, (ast.Name, ast.Subscript))
+                and isinstance(tree.ctx, ast.Load)
+            )
         ):
             new_env = dict(get_env(shell.user_ns))  # shallow copy of env
         else:
+            ns = get_env(shell.user_ns)
+            # only copy the values the code may change, all of them if that's unknown
+            names = None
+            if call is None:
+                extra_code = [ast.parse(pre_code or ""), ast.parse(name or "")]
+                names = mutated_names([tree, *extra_code], ns)
             # might raise an error if object refuses pickle interface
             # used by deepcopy to restore class
-            new_env = utils.copy_env(get_env(shell.user_ns))
+            new_env = utils.copy_env(ns, names)
 
         # Apply additional env and context variables
         if env is not None:
@@ -471,6 +944,7 @@ def taskRunEval(
         return e
 
 
-getResultInProcess = get_rep(taskRunEval)
-getOutputInProcess = partial(get_output, taskRunEval)
-getErrorInProcess = partial(get_error, taskRunEval)
+getResultInProcess = memoize(get_rep(taskRunEval))
+getDigestInProcess = memoize(get_rep(taskRunEval, digest=True))
+getOutputInProcess = memoize(isolate(get_output, taskRunEval))
+getErrorInProcess = memoize(partial(get_error, isolate(taskRunEval)))
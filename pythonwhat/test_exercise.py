@@ -1,5 +1,22 @@
-from pythonwhat.State import State
-from pythonwhat.local import run_exercise
+import os
+import ast
+import asyncio
+import builtins
+import contextvars
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+
+from pythonwhat.State import Dispatcher, State
+from pythonwhat.local import (
+    run_exercise,
+    ForkServer,
+    LazyErrors,
+    LazyOutput,
+    SolutionCache,
+    WorkerPool,
+    tracing,
+)
+from pythonwhat.preload import imported_modules
 from pythonwhat.sct_syntax import Ex, get_chains
 from pythonwhat.utils import check_str, check_process
 from protowhat.Reporter import Reporter
@@ -18,6 +35,7 @@ def test_exercise(
     ex_type,
     error,
     force_diagnose=False,
+    trace=False,
 ):
     """
     Point of interaction with the Python backend.
@@ -31,13 +49,53 @@ def test_exercise(
             raw_student_output (str): The output which is given by executing the student's program.
             ex_type (str): The type of the exercise.
             error (tuple): A tuple with some information on possible errors.
+            trace (bool): Whether to time the tasks run in the processes, see local.Tracer.
     Returns:
             dict: Returns dict with correct - whether the SCT passed, message - the feedback message and
-              tags - the tags belonging to the SCT execution.
+              tags - the tags belonging to the SCT execution. When tracing, timing holds
+              the timing report of the tasks, and the hits and misses of the cache of
+              their results.
     """
 
-    reporter = Reporter(errors=[error] if error else [])
+    with tracing(trace) as tracer:
+        payload, state = execute_sct(
+            sct,
+            student_code,
+            solution_code,
+            pre_exercise_code,
+            student_process,
+            solution_process,
+            raw_student_output,
+            error,
+            force_diagnose,
+        )
+    if tracer is not None:
+        payload["timing"] = tracer.report()
+        if state is not None:
+            # no state is built when e.g. the student code has a syntax error
+            payload["timing"]["representations"] = state.representations.stats()
+        payload["timing"]["parsing"] = Dispatcher.parse_cache.stats()
+    return payload
+
 
+def execute_sct(
+    sct,
+    student_code,
+    solution_code,
+    pre_exercise_code,
+    student_process,
+    solution_process,
+    raw_student_output,
+    error,
+    force_diagnose,
+):
+    """Run the SCT, return the payload and the root state, or None if it wasn't built"""
+    reporter = Reporter(errors=get_errors(error))
+
+    if not isinstance(raw_student_output, LazyOutput):
+        check_str(raw_student_output)
+
+    state = None
     try:
         state = State(
             student_code=check_str(student_code),
@@ -45,7 +103,7 @@ def test_exercise(
             pre_exercise_code=check_str(pre_exercise_code),
             student_process=check_process(student_process),
             solution_process=check_process(solution_process),
-            raw_student_output=check_str(raw_student_output),
+            raw_student_output=raw_student_output,
             force_diagnose=force_diagnose,
             reporter=reporter,
         )
@@ -65,9 +123,251 @@ def test_exercise(
         if isinstance(e, InstructorError):
             # TODO: decide based on context
             raise e
-        return reporter.build_failed_payload(e.feedback)
+        return reporter.build_failed_payload(e.feedback), state
+
+    return reporter.build_final_payload(), state
+
+
+def get_errors(error):
+    if isinstance(error, LazyErrors):
+        return error
+    return [error] if error else []
+
+
+# SCT functions that don't use the student or solution process
+STATIC_SCT_FUNCTIONS = {
+    "Ex",
+    "F",
+    "allow_errors",
+    "check_args",
+    "check_bases",
+    "check_body",
+    "check_call",
+    "check_class_def",
+    "check_context",
+    "check_correct",
+    "check_dict_comp",
+    "check_file",
+    "check_finalbody",
+    "check_for_loop",
+    "check_function_def",
+    "check_generator_exp",
+    "check_handlers",
+    "check_if_else",
+    "check_if_exp",
+    "check_ifs",
+    "check_iter",
+    "check_key",
+    "check_lambda_function",
+    "check_list_comp",
+    "check_not",
+    "check_or",
+    "check_orelse",
+    "check_test",
+    "check_try_except",
+    "check_value",
+    "check_while",
+    "check_with",
+    "disable_highlighting",
+    "fail",
+    "has_code",
+    "has_context",
+    "has_dir",
+    "has_equal_ast",
+    "has_equal_name",
+    "has_equal_part",
+    "has_equal_part_len",
+    "has_import",
+    "is_default",
+    "multi",
+    "override",
+    "set_context",
+    "set_env",
+    "success_msg",
+} | set(dir(builtins))
+
+# SCT functions that only use the student process, its output or its errors
+STUDENT_SCT_FUNCTIONS = {"has_chosen", "has_no_error", "has_output"}
+
+
+def processes_needed(sct):
+    """
+    Find the processes an SCT uses, by looking at the functions it calls.
+
+    Calls of functions that aren't known to be static are assumed to use both processes.
+    Args:
+            sct (str): The solution correctness test as a string of code.
+    Returns:
+            set: With ``"student"`` and/or ``"solution"``.
+    """
+    both = {"solution", "student"}
+    try:
+        tree = ast.parse(sct)
+    except SyntaxError:
+        return both
+
+    needed = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        if isinstance(node.func, ast.Name):
+            name = node.func.id
+        elif isinstance(node.func, ast.Attribute):
+            name = node.func.attr
+        else:
+            return both
+
+        if name == "check_function":
+            # the signature of the function is looked up in the processes
+            if not any(
+                keyword.arg == "signature"
+                and isinstance(keyword.value, ast.Constant)
+                and keyword.value.value is False
+                for keyword in node.keywords
+            ):
+                return both
+        elif name in STUDENT_SCT_FUNCTIONS:
+            needed.add("student")
+        elif name not in STATIC_SCT_FUNCTIONS:
+            return both
+    return needed
 
-    return reporter.build_final_payload()
+
+# threads of the SCTs of concurrent gradings, see async_test_exercise
+sct_executor = ThreadPoolExecutor(thread_name_prefix="pythonwhat-sct")
+
+
+async def async_test_exercise(*args, **kwargs):
+    """
+    Like ``test_exercise``, but the event loop keeps running while the SCT runs.
+
+    SCTs of concurrent gradings run in threads of ``sct_executor``, each in a
+    copy of the current context, so they have their own ``State.root_state``.
+    The code of submissions runs in their processes (see ``async_run_exercise``),
+    an SCT waits for the results of the tasks it runs there in its own thread.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        sct_executor, partial(context.run, test_exercise, *args, **kwargs)
+    )
+
+
+def grade_batch(
+    exercise,
+    submissions,
+    workers=None,
+    ordered=True,
+    time_limit=None,
+    memory_limit=None,
+    **kwargs
+):
+    """
+    Grade many submissions to one exercise in a pool of processes.
+
+    Every grading process compiles the SCT and runs the solution once, and reuses
+    them for all submissions it grades. The processes that run the submissions
+    preload the modules that the PEC and solution import.
+    A submission of which the grading fails gets an error payload, with the
+    ``error`` that was raised, instead of stopping the batch.
+    Args:
+            exercise (dict): The ``sct``, ``solution_code`` and ``pre_exercise_code``
+              of the exercise, and optionally its ``ex_type``.
+            submissions (iterable): The codes entered by the students.
+            workers (int): The number of grading processes, by default the number of cores.
+            ordered (bool): Whether to yield results in the order of the submissions,
+              otherwise they are yielded as soon as they are graded.
+            time_limit (float): Seconds every task in the processes may take.
+            memory_limit (int): Bytes of memory the processes may use.
+            kwargs: Passed on to ``run_exercise``, e.g. ``mode``.
+    Returns:
+            generator: Yields tuples with the index of a submission and its payload
+              (see ``test_exercise``).
+    """
+    limits = {"time_limit": time_limit, "memory_limit": memory_limit}
+    executor = ProcessPoolExecutor(
+        max_workers=workers or os.cpu_count(),
+        initializer=init_batch_worker,
+        initargs=(exercise, limits, kwargs),
+    )
+    futures = []
+    try:
+        futures = [executor.submit(grade_submission, code) for code in submissions]
+        indices = {future: i for i, future in enumerate(futures)}
+        for future in futures if ordered else as_completed(futures):
+            try:
+                payload = future.result()
+            except Exception as e:
+                # e.g. a grading process died
+                payload = error_payload(e)
+            yield indices[future], payload
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown()
+
+
+def error_payload(error):
+    return {
+        "correct": False,
+        "message": "Grading the submission failed.",
+        "error": "%s: %s" % (type(error).__name__, error),
+    }
+
+
+# exercise and processes of a grade_batch worker, set by init_batch_worker
+batch_worker = {}
+
+
+def init_batch_worker(exercise, limits, kwargs):
+    preload = imported_modules(exercise["pre_exercise_code"], exercise["solution_code"])
+    if kwargs.get("mode") == "fork":
+        kwargs = {**kwargs, "server": ForkServer(preload=preload, **limits)}
+    batch_worker.update(
+        sct=compile(exercise["sct"], "<sct>", "exec"),
+        needed=processes_needed(exercise["sct"]),
+        solution_code=exercise["solution_code"],
+        pre_exercise_code=exercise["pre_exercise_code"],
+        ex_type=exercise.get("ex_type", "NormalExercise"),
+        solution_cache=SolutionCache(max_size=1),
+        # the next process preloads the modules while a submission is graded
+        pool=WorkerPool(size=1, preload=preload, **limits),
+        kwargs=kwargs,
+    )
+
+
+def grade_submission(student_code):
+    try:
+        solution_process, student_process, raw_student_output, error = run_exercise(
+            batch_worker["pre_exercise_code"],
+            batch_worker["solution_code"],
+            student_code,
+            solution_cache=batch_worker["solution_cache"],
+            pool=batch_worker["pool"],
+            needed=batch_worker["needed"],
+            **batch_worker["kwargs"]
+        )
+    except Exception as e:
+        return error_payload(e)
+    try:
+        return test_exercise(
+            sct=batch_worker["sct"],
+            student_code=student_code,
+            solution_code=batch_worker["solution_code"],
+            pre_exercise_code=batch_worker["pre_exercise_code"],
+            student_process=student_process,
+            solution_process=solution_process,
+            raw_student_output=raw_student_output,
+            ex_type=batch_worker["ex_type"],
+            error=error,
+        )
+    except Exception as e:
+        # e.g. an InstructorError that depends on the submission
+        return error_payload(e)
+    finally:
+        batch_worker["pool"].release(student_process)
+        # a copy of the cached solution process
+        solution_process.kill()
 
 
 # TODO: consistent success_msg
@@ -123,7 +423,7 @@ def setup_state(stu_code="", sol_code="", pec="", **kwargs):
         student_process=stu_process,
         solution_process=sol_process,
         raw_student_output=raw_stu_output,
-        reporter=Reporter(errors=[error] if error else []),
+        reporter=Reporter(errors=get_errors(error)),
     )
 
     State.root_state = state
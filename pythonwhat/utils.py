@@ -34,7 +34,8 @@ def has_newline(text):
     return "\n" in text
 
 
-def copy_env(env):
+def copy_env(env, names=None):
+    """Copy env, deep copying its mutable values, or only those in names if given"""
     mutableTypes = (tuple, list, dict)
     # One list comprehension to filter list. Might need some cleaning, but it
     # works
@@ -46,6 +47,7 @@ def copy_env(env):
             (key.startswith("_"), isinstance(value, ModuleType), key in ipy_ignore)
         )
         and isinstance(value, mutableTypes)
+        and (names is None or key in names)
     }
     updated_env = dict(env)
     updated_env.update(update_env)
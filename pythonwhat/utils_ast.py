@@ -1,17 +1,19 @@
 import ast
+import types
 
 from protowhat.failure import debugger
 
 
 def wrap_in_module(node):
     new_node = ast.Module(node, [])
+    # tokens are only marked on demand (see State.CodeTokens), copy them if they are
     if isinstance(node, list):
-        if len(node) > 0:
+        if len(node) > 0 and hasattr(node[0], "first_token"):
             new_node.first_token = node[0].first_token
             new_node.last_token = node[-1].last_token
         else:
             pass  # do nothing
-    else:
+    elif hasattr(node, "first_token"):
         new_node.first_token = node.first_token
         new_node.last_token = node.first_token
     return new_node
@@ -34,3 +36,241 @@ def assert_ast(state, element, fmt_kwargs):
         return
     with debugger(state):
         state.report(err_msg, fmt_kwargs)
+
+
+# builtins that don't change their arguments or run code of their own
+PURE_BUILTINS = {
+    "abs",
+    "all",
+    "any",
+    "ascii",
+    "bin",
+    "bool",
+    "bytes",
+    "chr",
+    "complex",
+    "dict",
+    "divmod",
+    "enumerate",
+    "filter",
+    "float",
+    "format",
+    "frozenset",
+    "hash",
+    "hex",
+    "int",
+    "isinstance",
+    "issubclass",
+    "len",
+    "list",
+    "map",
+    "max",
+    "min",
+    "oct",
+    "ord",
+    "pow",
+    "print",
+    "range",
+    "repr",
+    "reversed",
+    "round",
+    "set",
+    "slice",
+    "sorted",
+    "str",
+    "sum",
+    "tuple",
+    "type",
+    "zip",
+}
+
+# builtins that call the functions they're passed, e.g. map(lst.pop, ...)
+CALLING_BUILTINS = {"filter", "map"}
+
+# types of which getting an item runs no other code, unlike e.g. defaultdict
+PURE_CONTAINERS = {bytearray, bytes, dict, list, range, str, tuple}
+
+
+def root_names(node):
+    return {n.id for n in ast.walk(node) if isinstance(n, ast.Name)}
+
+
+class MutationFinder(ast.NodeVisitor):
+    """Find the names whose values running code may change in place.
+
+    Rebinding a name (``x = 1``, ``del x``) doesn't change the value it was bound to,
+    but assigning to, or deleting, an item or attribute of it does, as do augmented
+    assignments, methods called on it, calls it's passed to (except for
+    ``PURE_BUILTINS``) and context managers. Functions passed to pure builtins, like
+    ``map(lst.pop, ...)`` or ``sorted(key=lst.append)``, are called on their root.
+    Calling anything else, e.g. a function defined in the code, could change any
+    value: ``unknown`` is set then.
+    Names of which items are taken are collected in ``subscripted``, as getting
+    an item can change e.g. a defaultdict, and all names that are used in ``loaded``.
+    Names bound by the code itself are collected in ``bound``, as they may refer
+    to (parts of) other values.
+    """
+
+    def __init__(self):
+        self.names = set()
+        self.called = set()
+        self.bound = set()
+        self.subscripted = set()
+        self.loaded = set()
+        self.unknown = False
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self.loaded.add(node.id)
+        else:
+            self.bound.add(node.id)
+
+    def visit_arg(self, node):
+        self.bound.add(node.arg)
+        self.generic_visit(node)
+
+    def visit_alias(self, node):
+        self.bound.add((node.asname or node.name).split(".")[0])
+
+    def visit_ExceptHandler(self, node):
+        if node.name:
+            self.bound.add(node.name)
+        self.generic_visit(node)
+
+    def mutate(self, target):
+        if isinstance(target, (ast.Tuple, ast.List)):
+            for elt in target.elts:
+                self.mutate(elt)
+        elif isinstance(target, ast.Starred):
+            self.mutate(target.value)
+        elif not isinstance(target, ast.Name):
+            self.names |= root_names(target)
+
+    def visit_Assign(self, node):
+        for target in node.targets:
+            self.mutate(target)
+        self.generic_visit(node)
+
+    def visit_AnnAssign(self, node):
+        self.mutate(node.target)
+        self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        # e.g. += extends lists in place, and doesn't bind the name to something else
+        self.names |= root_names(node.target)
+        if isinstance(node.target, ast.Name):
+            self.visit(node.value)
+        else:
+            self.generic_visit(node)
+
+    def visit_Delete(self, node):
+        for target in node.targets:
+            self.mutate(target)
+        self.generic_visit(node)
+
+    def visit_For(self, node):
+        self.mutate(node.target)
+        self.generic_visit(node)
+
+    visit_AsyncFor = visit_For
+
+    def visit_comprehension(self, node):
+        self.mutate(node.target)
+        self.generic_visit(node)
+
+    def visit_withitem(self, node):
+        self.names |= root_names(node.context_expr)
+        if node.optional_vars is not None:
+            self.mutate(node.optional_vars)
+        self.generic_visit(node)
+
+    def visit_Subscript(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self.subscripted |= root_names(node.value)
+        self.generic_visit(node)
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Name) and node.func.id in PURE_BUILTINS:
+            self.called.add(node.func.id)
+            passed = [kw.value for kw in node.keywords]
+            if node.func.id in CALLING_BUILTINS:
+                passed += node.args[:1]
+            for arg in passed:
+                # lambdas are visited, their calls are found there
+                if not isinstance(arg, ast.Lambda):
+                    self.names |= root_names(arg)
+        elif isinstance(node.func, ast.Attribute):
+            # the method can change its object and its arguments
+            self.names |= root_names(node.func.value)
+            for arg in node.args + [kw.value for kw in node.keywords]:
+                self.names |= root_names(arg)
+        else:
+            self.unknown = True
+        self.generic_visit(node)
+
+    def visit_Yield(self, node):
+        self.unknown = True
+
+    visit_YieldFrom = visit_Await = visit_Yield
+
+
+def mutated_names(nodes, namespace):
+    """Names in namespace whose values running nodes may change in place.
+
+    Returns None when any value may change: when the code calls something unknown,
+    shadows a pure builtin, or when the namespace holds functions or classes
+    defined in it, whose code could run implicitly (e.g. ``__add__`` or a property).
+    Values of which items are taken are included, unless they are ``PURE_CONTAINERS``
+    of which all nested containers are too.
+    """
+    finder = MutationFinder()
+    for node in nodes:
+        if isinstance(node, list):
+            for child in node:
+                finder.visit(child)
+        elif node is not None:
+            finder.visit(node)
+
+    if finder.unknown or finder.called & set(namespace) or finder.names & finder.bound:
+        return None
+    if any(defined_in(value, namespace) for value in namespace.values()):
+        return None
+    subscripted = finder.subscripted
+    if subscripted & finder.bound:
+        # items are taken of names bound to (parts of) any of the used values
+        subscripted = finder.loaded
+    unsafe = {
+        name
+        for name in subscripted
+        if name in namespace and not pure_container(namespace[name])
+    }
+    return finder.names | unsafe
+
+
+def pure_container(value, seen=None):
+    """Whether getting (nested) items of value runs no code that could change it"""
+    if type(value) is dict:
+        items = value.values()
+    elif type(value) in (list, tuple):
+        items = value
+    else:
+        return type(value) in PURE_CONTAINERS or not hasattr(type(value), "__getitem__")
+
+    seen = seen or set()
+    if id(value) in seen:
+        return True
+    seen.add(id(value))
+    return all(pure_container(item, seen) for item in items)
+
+
+def defined_in(value, namespace):
+    """Whether value is a function or class defined by code run in namespace"""
+    if isinstance(value, type):
+        return any(defined_in(attr, namespace) for attr in vars(value).values())
+    if isinstance(value, (staticmethod, classmethod, types.MethodType)):
+        return defined_in(value.__func__, namespace)
+    if isinstance(value, property):
+        return any(
+            defined_in(f, namespace) for f in (value.fget, value.fset, value.fdel)
+        )
+    return isinstance(value, types.FunctionType) and value.__globals__ is namespace
@@ -1,5 +1,15 @@
+import ast
+from collections.abc import Mapping
+
 import pytest
+from pythonwhat.parsing import (
+    FunctionParser,
+    ObjectAccessParser,
+    TreeIndex,
+    parser_dict,
+)
 from pythonwhat.State import Dispatcher
+from pythonwhat.test_exercise import setup_state
 
 
 @pytest.mark.parametrize(
@@ -35,3 +45,103 @@ from pythonwhat.State import Dispatcher
 )
 def test_parses_without_error(script):
     Dispatcher().parse(script)
+
+
+def comparable(out):
+    # function bodies are transformed copies, so nodes are compared by their dump
+    if isinstance(out, ast.AST):
+        return ast.dump(out, include_attributes=True)
+    if isinstance(out, Mapping):
+        return {k: comparable(v) for k, v in out.items()}
+    if isinstance(out, (list, tuple)):
+        return [comparable(v) for v in out]
+    return out
+
+
+index_scripts = [
+    """
+import numpy as np
+from math import sqrt as s
+x = np.array([1, 2]).mean() + s(abs(-4))
+y = [i * 2 for i in range(3)]
+z = {k: v for k, v in zip("ab", [1, 2]) if v}
+g = (i for i in x)
+f = lambda a, b=1: a + b
+w = 1 if x else 2
+print(np.sum(x), sep=" ")
+""",
+    """
+class A(object):
+    def m(self):
+        return 1
+
+def f(a, *args, b=2, **kwargs):
+    if a:
+        return a
+    nonlocal_value = [a, b]
+
+for i, j in enumerate(range(3)):
+    y = i
+else:
+    pass
+while y:
+    y -= 1
+with open("f") as f1, open("g"):
+    z = f1.read()
+try:
+    z.x = 1
+except (TypeError, ValueError) as e:
+    pass
+except KeyError:
+    pass
+finally:
+    del z
+""",
+    "x.y.z(1)[0].t",
+]
+
+
+@pytest.mark.parametrize("script", index_scripts)
+def test_tree_index_same_as_parsers(script):
+    tree = Dispatcher.parse_code(script)[1]
+    mappings = {"pd": "pandas"}
+    index = TreeIndex(tree, mappings)
+
+    for key, Parser in parser_dict.items():
+        p = Parser()
+        if Parser in [FunctionParser, ObjectAccessParser]:
+            p.mappings = mappings.copy()
+        p.visit(tree)
+        assert comparable(index.get(key)) == comparable(p.out), key
+        if key == "function_calls":
+            assert index.get("mappings") == p.mappings
+        if key == "object_accesses":
+            assert index.get("oa_mappings") == p.mappings
+    assert mappings == {"pd": "pandas"}
+
+
+def test_tree_index_single_pass():
+    dispatcher = Dispatcher()
+    tree = Dispatcher.parse_code(index_scripts[0])[1]
+    dispatcher.function_calls(tree)
+    (index,) = dispatcher._indexes.values()
+    parsers = index.parsers
+
+    dispatcher.list_comps(tree)
+    assert dispatcher.mappings(tree) == {"np": "numpy", "s": "math.sqrt"}
+    assert index.parsers is parsers
+    assert "numpy.sum" in dispatcher.function_calls(tree)
+
+
+def test_tree_index_shared_with_children():
+    code = "for i in range(3):\n    print(i)\n    x = abs(i)"
+    chain = setup_state(code, code)
+    dispatcher = chain._state.ast_dispatcher
+
+    for _ in range(2):
+        body = chain.check_for_loop().check_body()
+        body.check_function("print")
+        body.check_function("abs")
+    # the root tree and the for loop body, the same code is parsed once
+    assert len(dispatcher._indexes) == 2
+    assert body._state.ast_dispatcher is dispatcher
@@ -59,6 +59,19 @@ def test_python_file_existence(temp_py_file):
     assert child.solution_ast is not None
 
 
+def test_check_file_path_in_children(temp_py_file):
+    chain = setup_state("", "", pec="")
+
+    child = cf.check_file(chain._state, temp_py_file.name)
+    grandchild = child.to_child(student_ast=child.student_ast.body[0])
+
+    assert str(grandchild.path) == temp_py_file.name
+    with pytest.raises(TF) as exception:
+        grandchild.report("wrong")
+    highlight = exception.value.feedback.get_highlight()
+    assert highlight["path"] == temp_py_file.name
+
+
 def test_file_existence_syntax(temp_py_file):
     """test integration of protowhat checks in pythonwhat"""
     expected_content = cf.get_file_content(temp_py_file.name)
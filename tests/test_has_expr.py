@@ -1,6 +1,9 @@
 import pytest
+from pythonwhat import tasks
+from pythonwhat.local import tracing
+from pythonwhat.tasks import content_digest
 from pythonwhat.test_exercise import setup_state
-from protowhat.failure import InstructorError
+from protowhat.failure import InstructorError, TestFail as TF
 import tests.helper as helper
 
 
@@ -127,3 +130,106 @@ def test_has_expr_override_pass_2():
     sol = "x = [1, 2, 5]"
     s = setup_state(stu_code=stu, sol_code=sol)
     helper.passes(s.check_object("x").has_equal_value(override=[1, 2, 3]))
+
+
+df = "import pandas as pd\ndf = pd.DataFrame({'a': [1, 2, None], 'b': list('xyz')})"
+
+
+@pytest.mark.parametrize(
+    "stu, sol, passes",
+    [
+        (df, df, True),
+        (df, df.replace("'xyz'", "'xyw'"), False),
+        (df, df + ".set_index('b')", False),
+        ("import numpy as np; df = np.arange(9.0).reshape(3, 3)", None, True),
+        ("df = {'b': [1, 2], 'a': {3}}", "df = {'a': {3}, 'b': [1, 2]}", True),
+        ("df = [1, 2]", "df = [1.0, 2.0]", True),  # equal, but compared in full
+        ("df = [1, 2]", "df = [1, 3]", False),
+        ("df = float('nan')", None, False),
+    ],
+)
+def test_has_equal_value_digest(stu, sol, passes):
+    s = setup_state(stu, sol or stu)
+    with helper.verify_sct(passes):
+        s.check_object("df").has_equal_value(compare="digest")
+
+
+@pytest.mark.parametrize("compare, sent", [(None, True), ("digest", False)])
+def test_has_equal_value_digest_sends_digests(compare, sent):
+    code = "x = [str(i) for i in range(10 ** 4)]"
+    s = setup_state(code, code)
+    with tracing() as tracer:
+        s.check_object("x").has_equal_value(compare=compare)
+
+    received = max(task["received_bytes"] for task in tracer.records)
+    assert (received > 10 ** 4) == sent
+
+
+def test_has_equal_value_digest_message():
+    s = setup_state("x = [1, 2]", "x = [1, 3]")
+    msg = "got {{stu_eval}}, expected {{sol_eval}}"
+    with pytest.raises(TF, match=r"got \[1, 2\], expected \[1, 3\]"):
+        s.has_equal_value(expr_code="x", incorrect_msg=msg, compare="digest")
+
+
+@pytest.mark.parametrize(
+    "kwargs", [{"compare": "pickle"}, {"compare": "digest", "func": lambda x, y: x}]
+)
+def test_has_equal_value_digest_misuse(kwargs):
+    s = setup_state("x = 1", "x = 1")
+    with pytest.raises(InstructorError):
+        s.has_equal_value(expr_code="x", **kwargs)
+
+
+@pytest.mark.parametrize(
+    "x, y",
+    [
+        ([1, {"a": (2, None)}], [1, {"a": (2, None)}]),
+        ({1, 2, 3}, {3, 2, 1}),
+        ({"a": 1, "b": 2}, {"b": 2, "a": 1}),
+    ],
+)
+def test_content_digest_equal(x, y):
+    assert content_digest(x) is not None
+    assert content_digest(x) == content_digest(y)
+
+
+@pytest.mark.parametrize(
+    "x, y", [([1, 2], [2, 1]), ([1], (1,)), (1, True), (1, 1.0), ({"a": 1}, {"a": 2})]
+)
+def test_content_digest_differs(x, y):
+    assert content_digest(x) != content_digest(y)
+
+
+def test_content_digest_unknown_type():
+    assert content_digest(object()) is None
+    assert content_digest([object()]) is None
+
+
+def test_has_equal_value_fork():
+    code = """
+x = [1, 2]
+class NoCopy(list):
+    def __deepcopy__(self, memo):
+        raise TypeError("no copy")
+y = NoCopy([1])
+"""
+    s = setup_state(code, code)
+    with helper.verify_sct(True):
+        s.has_equal_value(expr_code="x.append(3) or x + y", copy="fork")
+    with helper.verify_sct(True):
+        s.has_equal_value(expr_code="x", override=[1, 2])
+    with pytest.raises(InstructorError):
+        s.has_equal_value(expr_code="y.append(3) or y")
+
+
+@pytest.mark.parametrize("test, expr", [("output", "f()"), ("error", "f() + 1")])
+def test_has_equal_output_error_fork(test, expr, monkeypatch):
+    monkeypatch.setattr(tasks, "ISOLATION", "fork")
+    code = "x = [1]\ndef f():\n    x.append(2)\n    print(x)"
+    s = setup_state(code, code)
+    with helper.verify_sct(True), tracing() as tracer:
+        getattr(s, "has_equal_%s" % test)(expr_code=expr)
+    assert [task["function"] for task in tracer.records] == ["TaskIsolated"] * 2
+    with helper.verify_sct(True):
+        s.has_equal_value(expr_code="x", override=[1])
@@ -43,3 +43,24 @@ def test_test_output_contains(stu, passes):
     s = setup_state(stu, "")
     with helper.verify_sct(passes):
         s.test_output_contains(r"[H|h]i,*\s+there!")
+
+
+@pytest.mark.parametrize(
+    "text, pattern, passes",
+    [
+        ("line 0\n", False, True),
+        ("line 99999\n", False, True),
+        ("line 50000", False, False),
+        ("characters of output dropped", False, False),
+        (r"line 9+$", True, True),
+        (r"line 0\n\.\.\.", True, False),
+    ],
+)
+def test_has_output_dropped_output(monkeypatch, text, pattern, passes):
+    monkeypatch.setattr("pythonwhat.local.OUTPUT_LIMIT", 1000)
+    s = setup_state("for i in range(100000): print('line %d' % i)", "")
+    output = s._state.raw_student_output
+    assert len(output) < 1100
+    assert output.startswith("line 0\n") and output.endswith("line 99999\n")
+    with helper.verify_sct(passes):
+        s.has_output(text, pattern=pattern)
@@ -52,3 +52,14 @@ def test_has_printout_multiple(stu):
     sol = 'print("randomness")\nprint(1, 2, 3)'
     s = setup_state(stu_code=stu, sol_code=sol)
     helper.passes(s.has_printout(1))
+
+
+@pytest.mark.parametrize(
+    "stu, correct",
+    [("print('ab' * 2000)", True), ("print('ab' * 100)", False), ("", False)],
+)
+def test_has_printout_dropped_output(monkeypatch, stu, correct):
+    monkeypatch.setattr("pythonwhat.local.OUTPUT_LIMIT", 1000)
+    s = setup_state(stu_code=stu, sol_code="print('ab' * 2000)")
+    with helper.verify_sct(correct):
+        s.has_printout(0)
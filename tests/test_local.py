@@ -1,11 +1,44 @@
 import os
+import time
+import signal
+import asyncio
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 
-from pythonwhat.local import ChDir
-from pythonwhat.test_exercise import setup_state
+from pythonwhat import local
+from pythonwhat.local import (
+    BoundedOutput,
+    ChDir,
+    ForkServer,
+    Memo,
+    SolutionCache,
+    WorkerPool,
+    WorkerProcess,
+    async_run_exercise,
+    run_exercise,
+    run_single_process,
+)
+from pythonwhat.tasks import (
+    execute_tasks,
+    getClass,
+    getOptionFromProcess,
+    getRepresentation,
+    getResultInProcess,
+    getStreamPickle,
+    isDefinedInProcess,
+    loadValue,
+    ReprFail,
+    RepresentationCache,
+    SharedMemoryStream,
+)
+from pythonwhat.test_exercise import async_test_exercise, setup_state
+from pythonwhat.sct_syntax import v2_check_functions
+
+check_function = v2_check_functions["check_function"]
 from tests.helper import verify_sct, in_temp_dir
+from protowhat.failure import TestFail as TF
 
 modify_sys = (
     """
@@ -45,6 +78,151 @@ def test_running_code_isolation_run(sol_code, stu_code):
         chain.run().has_equal_value(name="bar", override="bar")
 
 
+@pytest.mark.parametrize("sol_code, stu_code", [modify_sys])
+def test_running_code_isolation_run_reuse(sol_code, stu_code):
+    with WorkerPool(size=2, reuse=True) as pool:
+        WorkerPool.default = pool
+        try:
+            for _ in range(3):
+                chain = setup_state(sol_code, stu_code, pec="")
+                chain._state.solution_code = sol_code
+                chain._state.student_code = stu_code
+
+                with verify_sct(False):
+                    chain.run().has_equal_value(name="bar", override="bar")
+
+                pool.release(chain._state.student_process)
+                pool.release(chain._state.solution_process)
+        finally:
+            WorkerPool.default = None
+
+
+def test_reused_process_is_restored():
+    pec = "import os\nx = [1]"
+    with WorkerPool(size=1, reuse=True) as pool:
+        with in_temp_dir() as d:
+            code = "import sys\nx.append(2)\ny = 1\nsys.stash = open(os.devnull)"
+            first = run_single_process(pec, code + "\nos.chdir('/')", pool=pool)[0]
+            pool.release(first)
+            code = "import sys\nstashed = hasattr(sys, 'stash')\ncwd = os.getcwd()"
+            second = run_single_process(pec, code, pool=pool)[0]
+
+            assert second is not first
+            assert pool.server.stats["templates"] == 1
+            assert getOptionFromProcess(second, "x") == [1]
+            assert not isDefinedInProcess("y", second)
+            assert not getOptionFromProcess(second, "stashed")
+            assert getOptionFromProcess(second, "cwd") == os.path.realpath(d)
+            pool.release(second)
+
+            # a different PEC doesn't get a copy of the template
+            run_single_process("", "", pool=pool)
+            assert pool.server.stats["templates"] == 2
+
+
+def test_reused_process_keeps_module_state():
+    pec = "import random\nrandom.seed(42)"
+    with WorkerPool(size=2, reuse=True) as pool:
+        values = []
+        for _ in range(3):
+            process = run_single_process(pec, "x = random.random()", pool=pool)[0]
+            values.append(getOptionFromProcess(process, "x"))
+            pool.release(process)
+
+        assert values[0] == values[1] == values[2]
+
+
+def test_reused_processes_are_kept_per_role():
+    with WorkerPool(size=2, reuse=True) as pool:
+        for _ in range(2):
+            sol_process, stu_process, _, _ = run_exercise(
+                "", "x = 1", "x = 2", pool=pool
+            )
+            assert getOptionFromProcess(sol_process, "x") == 1
+            assert getOptionFromProcess(stu_process, "x") == 2
+            pool.release(sol_process)
+            pool.release(stu_process)
+
+        server = pool.server
+        assert set(server.templates) == {
+            server.get_key("", os.getcwd(), role) for role in ["solution", "student"]
+        }
+        assert server.stats["forked"] == 4
+
+
+@pytest.mark.parametrize(
+    "limits, retired",
+    [
+        ({}, None),
+        ({"max_tasks": 4}, "retired_tasks"),
+        ({"max_rss": 1024}, "retired_rss"),
+    ],
+)
+def test_pool_retires_processes(limits, retired):
+    with WorkerPool(size=1, preload=(), reuse=True, **limits) as pool:
+        for _ in range(3):
+            process = run_single_process("", "x = 1", pool=pool)[0]
+            pool.release(process)
+
+        stats = pool.server.stats
+        assert stats["forked"] == 3
+        if retired is None:
+            assert stats["templates"] == 1
+        elif retired == "retired_tasks":
+            # a template runs 2 tasks for the PEC and 1 for every copy
+            assert stats["templates"] == 2
+            assert stats[retired] == 1
+        else:
+            assert stats["templates"] == 3
+            assert stats[retired] == 2
+
+
+def test_dead_processes_are_reaped():
+    process = run_single_process("", "")[0]
+    process.terminate()
+    process.wait_for_exit(timeout=3.0)
+
+    assert process in WorkerProcess.instances
+    assert WorkerProcess.reap() == 1
+    assert process not in WorkerProcess.instances
+
+
+@pytest.mark.parametrize("sol_code, stu_code", [modify_sys])
+def test_running_code_isolation_pool(sol_code, stu_code):
+    with WorkerPool(size=2) as pool:
+        chain = setup_state(stu_code, sol_code, pec="", pool=pool)
+        assert chain._state.has_different_processes()
+
+        with verify_sct(False):
+            chain.has_equal_value(name="bar", override="bar")
+
+
+def test_pool_hands_out_started_processes_once():
+    with WorkerPool(size=1, preload=["json"]) as pool:
+        first = pool.acquire()
+        second = pool.acquire()
+
+        assert first.is_alive() and second.is_alive()
+        assert first is not second
+        assert len(pool.idle) == 1
+
+        pool.release(first)
+        assert not first.is_alive()
+        assert first not in pool.idle
+
+
+def test_pool_process_uses_current_working_dir():
+    with WorkerPool(size=1) as pool:
+        with in_temp_dir() as d:
+            chain = setup_state(
+                "import os; cwd = os.getcwd()",
+                "import os; cwd = os.getcwd()",
+                pec="",
+                pool=pool,
+            )
+            chain.check_object("cwd").has_equal_value(override=os.path.realpath(d))
+
+
 @pytest.mark.parametrize(
     "sol_code, stu_code",
     [
@@ -95,6 +273,566 @@ def test_urlopen_in_process(sol_code, stu_code):
             chain.run()
 
 
+def test_run_exercise_runs_processes_concurrently():
+    code = "import time; start = time.time(); time.sleep(1); end = time.time()"
+    sol_process, stu_process, _, _ = run_exercise("", code, code)
+
+    get_times = lambda p: [getOptionFromProcess(p, n) for n in ["start", "end"]]
+    sol_start, sol_end = get_times(sol_process)
+    stu_start, stu_end = get_times(stu_process)
+
+    assert sol_start < stu_end and stu_start < sol_end
+
+
+def test_run_exercise_keeps_working_dir():
+    with in_temp_dir():
+        d = os.getcwd()
+        os.makedirs("sol")
+        os.makedirs("stu")
+        code = "import os; cwd = os.getcwd()"
+        sol_process, stu_process, _, _ = run_exercise(
+            "", code, code, sol_wd="sol", stu_wd="stu"
+        )
+
+        assert os.getcwd() == d
+        assert getOptionFromProcess(sol_process, "cwd") == os.path.join(d, "sol")
+        assert getOptionFromProcess(stu_process, "cwd") == os.path.join(d, "stu")
+
+
+def test_fork_server_runs_pec_once():
+    pec = "with open('pec_runs', 'a') as f: f.write('x')\nx = [1]"
+    code = "x.append(2)"
+    with in_temp_dir(), ForkServer() as server:
+        for _ in range(2):
+            sol_process, stu_process, _, error = run_exercise(
+                pec, code, code, mode="fork", server=server
+            )
+            assert error is None
+            assert getOptionFromProcess(sol_process, "x") == [1, 2]
+            assert getOptionFromProcess(stu_process, "x") == [1, 2]
+
+        assert Path("pec_runs").read_text() == "x"
+        assert len(server.templates) == 1
+
+
+@pytest.mark.parametrize("sol_code, stu_code", [modify_sys])
+def test_running_code_isolation_fork(sol_code, stu_code):
+    with ForkServer() as server:
+        chain = setup_state(stu_code, sol_code, pec="", mode="fork", server=server)
+
+        with verify_sct(False):
+            chain.has_equal_value(name="bar", override="bar")
+
+
+@pytest.mark.parametrize("limits", [{"memory_budget": 0}, {"max_size": 1}])
+def test_fork_server_evicts_least_recently_used(limits):
+    with ForkServer(**limits) as server:
+        server.fork("a = 1", os.getcwd()).kill()
+        server.fork("b = 1", os.getcwd()).kill()
+
+        assert list(server.templates) == [server.get_key("b = 1", os.getcwd())]
+
+
+@pytest.mark.parametrize(
+    "limits, retired",
+    [
+        ({}, None),
+        ({"max_tasks": 3}, "retired_tasks"),
+        ({"max_rss": 1024}, "retired_rss"),
+    ],
+)
+def test_fork_server_retires_templates(limits, retired):
+    with ForkServer(**limits) as server:
+        for _ in range(2):
+            server.fork("x = 1", os.getcwd()).kill()
+        template = server.get_template("x = 1", os.getcwd())
+
+        # a template runs 2 tasks for the PEC and 1 for every copy
+        if retired is None:
+            assert template.task_count == 4
+        else:
+            assert server.stats[retired] == 2
+            assert template.task_count == 2
+
+
+def test_stub_process_queues_results():
+    process = local.StubProcess()
+    process.submitTask(local.TaskCaptureOutput("print(1)"))
+    process.submitTask(local.TaskCaptureOutput("print(2)"))
+
+    assert [process.getResult()[0] for _ in range(2)] == ["1\n", "2\n"]
+
+
+def test_dead_forked_process():
+    with ForkServer() as server:
+        process = server.fork("x = 1", os.getcwd())
+        os.kill(process.pid, signal.SIGKILL)
+        time.sleep(0.1)
+
+        assert not process.is_alive()
+        assert process.executeTask(local.TaskCaptureOutput("x"))[0]["type"] == (
+            "backend-error"
+        )
+
+
+def test_fork_server_forks_from_threads():
+    with ForkServer(accept_timeout=2.0) as server:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            processes = list(
+                executor.map(lambda _: server.fork("x = 1", os.getcwd()), range(8))
+            )
+
+        assert all(isinstance(process, local.ForkedProcess) for process in processes)
+        assert len(server.templates) == 1
+        for process in processes:
+            process.kill()
+
+
+class TaskForkDies(local.TaskFork):
+    def __call__(self, shell):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        return pid
+
+
+def test_fork_server_falls_back_when_child_doesnt_connect(monkeypatch):
+    monkeypatch.setattr(local, "TaskFork", TaskForkDies)
+    with ForkServer(accept_timeout=0.5) as server:
+        process = server.fork("x = [1]", os.getcwd())
+        try:
+            assert isinstance(process, WorkerProcess)
+            assert getOptionFromProcess(process, "x") == [1]
+        finally:
+            process.kill()
+
+
+def test_solution_cache_reuses_solution_process():
+    sol_code = "with open('sol_runs', 'a') as f: f.write('x')\nx = [1, 2]"
+    cache = SolutionCache()
+    with in_temp_dir():
+        chains = [
+            setup_state(stu_code, sol_code, solution_cache=cache)
+            for stu_code in ["x = [1, 2]", "x = [2, 1]"]
+        ]
+        sol_process = chains[0]._state.solution_process
+
+        assert Path("sol_runs").read_text() == "x"
+        # every grading gets a copy of the cached process, with the same memo
+        assert chains[1]._state.solution_process._identity == sol_process._identity
+        assert chains[1]._state.solution_process.memo is sol_process.memo
+        assert chains[0]._state.student_process is not chains[1]._state.student_process
+
+        chains[0].check_object("x").has_equal_value()
+        assert len(sol_process.memo) == 1
+        with verify_sct(False):
+            chains[1].check_object("x").has_equal_value()
+        assert len(sol_process.memo) == 1
+    cache.close()
+
+
+def test_solution_cache_copies_arent_changed_by_gradings():
+    code = "import random\nrandom.seed(42)\nx = [1, 2, 3]\ny = 3"
+    cache = SolutionCache()
+    for _ in range(3):
+        chain = setup_state(code, code, solution_cache=cache)
+        chain.check_object("y").has_equal_value(expr_code="x.pop()", copy=False)
+        chain.has_equal_value(expr_code="random.random()", copy=False)
+        chain._state.solution_process.kill()
+
+    assert len(cache.server.templates) == 1
+    cache.close()
+
+
+def test_solution_cache_keeps_first_of_concurrent_solutions():
+    cache = SolutionCache()
+    key = cache.get_key("", "x = 1", os.getcwd())
+    processes = [run_single_process("", "x = 1")[0] for _ in range(2)]
+    copies = [cache.add(key, process) for process in processes]
+
+    assert cache.server.templates[key] is processes[0]
+    assert not processes[1].is_alive()
+    assert [getOptionFromProcess(copy, "x") for copy in copies] == [1, 1]
+    cache.close()
+
+
+def test_solution_cache_retires_processes():
+    cache = SolutionCache(max_tasks=5)
+    key = cache.get_key("", "x = 1", os.getcwd())
+    # the solution process ran 3 tasks, and 1 to fork a copy
+    cache.add(key, run_single_process("", "x = 1")[0]).kill()
+    cache.get(key).kill()
+
+    assert cache.get(key) is None
+    assert cache.server.stats["retired_tasks"] == 1
+    assert key not in cache.server.templates
+    cache.close()
+
+
+def test_memo_drops_oldest_results():
+    memo = Memo(2)
+    for key in "abc":
+        memo[key] = key
+    assert list(memo) == ["b", "c"]
+
+
+def test_solution_cache_doesnt_memoize_in_with_context():
+    code = "from io import StringIO\nwith StringIO('a') as f:\n    print(f.read())"
+    cache = SolutionCache()
+    chain = setup_state(code, code, solution_cache=cache)
+    chain.check_with(0).check_body().with_context(
+        check_function("print").check_args(0).has_equal_value()
+    )
+
+    assert not chain._state.solution_process.memo
+    cache.close()
+
+
+def test_representation_cache():
+    code = "import pandas as pd\ndf = pd.DataFrame({'a': [1, 2], 'b': [3, 4]})"
+    chain = setup_state(code, code)
+    for _ in range(2):
+        chain.check_df("df").check_keys("a").has_equal_value()
+        chain.check_df("df").check_keys("b").has_equal_value()
+
+    assert chain._state.representations.stats() == {
+        "hits": 4,
+        "misses": 4,
+        "size": 4,
+    }
+
+
+def test_representation_cache_invalidated():
+    chain = setup_state("x = [1]", "x = [1]")
+    grow = chain.has_equal_value(expr_code="x.append(1)", copy=False)
+    with verify_sct(False):
+        grow.has_equal_value(expr_code="len(x)", override=1)
+    grow.has_equal_value(expr_code="len(x)", override=2, copy=False)
+    # the evaluation without copy may have changed x, so len(x) is evaluated again
+    grow.has_equal_value(expr_code="len(x)")
+
+    assert chain._state.representations.hits == 0
+
+
+@pytest.mark.parametrize(
+    "result, kept",
+    [
+        ((1, "1"), True),
+        ((local.TimeLimitExceeded("took too long"), "took too long"), False),
+        (local.backend_error("process exited"), False),
+    ],
+)
+def test_representation_cache_doesnt_keep_failures(result, kept):
+    cache, memo, calls = RepresentationCache(), Memo(2), []
+
+    def compute():
+        calls.append(1)
+        return result
+
+    for _ in range(2):
+        assert cache.get(memo, "key", compute) is result
+
+    assert len(calls) == (1 if kept else 2)
+    assert ("key" in memo) == kept
+
+
+@pytest.mark.parametrize("mode", ["stub", "simple", "fork"])
+def test_execute_tasks_in_one_round_trip(mode):
+    process = run_single_process("", "x = 1", mode=mode)[0]
+    calls = []
+    execute_task = process.executeTask
+    process.executeTask = lambda task: calls.append(task) or execute_task(task)
+
+    defined, value, missing, obj_class = execute_tasks(
+        process,
+        [
+            isDefinedInProcess.task("x"),
+            getOptionFromProcess.task(name="x"),
+            getOptionFromProcess.task(name="y"),
+            getClass.task("x"),
+        ],
+    )
+
+    assert len(calls) == 1
+    assert defined is True
+    assert value == 1
+    assert "backend-error" in str(missing)
+    assert obj_class == "builtins.int"
+
+
+@pytest.mark.parametrize(
+    "code",
+    [
+        "import numpy as np; x = np.arange(10 ** 6)",
+        "import pandas as pd; x = pd.DataFrame({'a': range(10 ** 6), 'b': 1.5})",
+    ],
+)
+def test_large_values_use_shared_memory(code):
+    chain = setup_state(code, code)
+    chain.check_object("x").has_equal_value()
+
+    process = chain._state.student_process
+    stream = getStreamPickle("x", process)
+    assert isinstance(stream, SharedMemoryStream)
+    assert os.path.exists("/dev/shm/" + stream.name)
+    stream.loads()
+    assert not os.path.exists("/dev/shm/" + stream.name)
+
+    value = getRepresentation("x", process)
+    assert len(value) == 10 ** 6
+
+
+def test_dropped_shared_memory_is_unlinked():
+    code = "import numpy as np; x = np.arange(10 ** 6)"
+    process = setup_state(code, code)._state.student_process
+
+    stream = getStreamPickle("x", process)
+    path = "/dev/shm/" + stream.name
+    assert os.path.exists(path)
+    del stream
+    assert not os.path.exists(path)
+
+
+def test_small_values_are_pickled():
+    code = "import numpy as np; x = np.arange(10)"
+    process = setup_state(code, code)._state.student_process
+
+    assert isinstance(getStreamPickle("x", process), bytes)
+    assert getRepresentation("x", process).tolist() == list(range(10))
+
+
+@pytest.mark.parametrize("mode", ["stub", "simple", "fork"])
+@pytest.mark.parametrize(
+    "code, expr, check",
+    [
+        ("import numpy as np", "np.arange(3)", lambda v: v.tolist() == [0, 1, 2]),
+        ("x = {'b': 1, 'a': 2}", "x.keys()", lambda v: v == ["a", "b"]),
+        ("f = lambda: 1", "f", lambda v: v() == 1),
+        ("", "(i for i in range(3))", lambda v: isinstance(v, ReprFail)),
+    ],
+)
+def test_result_in_one_round_trip(mode, code, expr, check):
+    chain = setup_state(code, code, mode=mode)
+    process = chain._state.student_process
+    calls = []
+    execute_task = process.executeTask
+    process.executeTask = lambda task: calls.append(task) or execute_task(task)
+
+    value, res = getResultInProcess(tree=None, expr_code=expr, process=process)
+
+    assert len(calls) == 1
+    assert check(value)
+
+
+def test_result_manual_conversion_fails():
+    code = "x = {1: 2}.keys()"
+    chain = setup_state(code, code)
+    chain._state.converters["builtins.dict_keys"] = lambda x: 1 / 0
+
+    process = chain._state.student_process
+    value, res = getResultInProcess(tree=None, expr_code="x", process=process)
+
+    assert isinstance(value, ReprFail)
+    assert value.info.startswith("manual conversion failed")
+    assert "division by zero" in value.info
+
+
+@pytest.mark.parametrize("mode", ["simple", "fork"])
+def test_result_class_not_importable(mode):
+    code = """
+import sys, types
+m = types.ModuleType("m")
+exec("class A:\\n    pass", m.__dict__)
+sys.modules["m"] = m
+x = m.A()
+"""
+    chain = setup_state(code, code, mode=mode)
+    process = chain._state.student_process
+    calls = []
+    execute_task = process.executeTask
+    process.executeTask = lambda task: calls.append(task) or execute_task(task)
+
+    value, res = getResultInProcess(tree=None, expr_code="x", process=process)
+
+    assert len(calls) == 1
+    assert isinstance(value, ReprFail)
+    assert "No module named 'm'" in value.info
+
+
+def test_load_value_falls_back_on_dill():
+    import dill
+
+    assert loadValue(("m.A", "pickle", b"not a pickle", dill.dumps(3))) == 3
+    value = loadValue(("m.A", "pickle", b"not a pickle", None))
+    assert isinstance(value, ReprFail)
+    assert value.info.startswith("unpickling failed for class m.A")
+
+
+loop = "def f():\n    while True:\n        pass"
+# the timer can't interrupt a long running call into C code
+c_loop = "def f():\n    return sum(range(10 ** 12))"
+
+
+@pytest.mark.parametrize("stu_code", [loop, c_loop])
+def test_time_limit(stu_code):
+    sol_code = "def f():\n    return 1"
+    with WorkerPool(size=0, preload=(), time_limit=0.5) as pool:
+        chain = setup_state(stu_code, sol_code, pool=pool)
+        with pytest.raises(TF, match="took longer than 0.5 seconds"):
+            chain.has_equal_value(expr_code="f()")
+
+
+@pytest.mark.parametrize("stu_code", [loop, c_loop])
+def test_time_limit_isolated(stu_code):
+    sol_code = "def f():\n    return 1"
+    with WorkerPool(size=0, preload=(), time_limit=0.5) as pool:
+        chain = setup_state(stu_code, sol_code, pool=pool)
+        with pytest.raises(TF, match="took longer than 0.5 seconds"):
+            chain.has_equal_value(expr_code="f()", copy="fork")
+        # the child was killed, the process keeps working
+        chain.has_equal_value(expr_code="1", copy="fork")
+
+
+def test_time_limit_fork():
+    sol_code = "def f():\n    return 1"
+    with ForkServer(time_limit=0.5) as server:
+        chain = setup_state(c_loop, sol_code, mode="fork", server=server)
+        with pytest.raises(TF, match="took longer than 0.5 seconds"):
+            chain.has_equal_value(expr_code="f()")
+
+
+def test_memory_limit():
+    code = "def f():\n    return len(bytearray(2 * 1024 ** 3))"
+    with WorkerPool(size=0, preload=(), memory_limit=1024 ** 3) as pool:
+        chain = setup_state(code, "def f():\n    return 1", pool=pool)
+        with pytest.raises(TF, match="used more than 1024 MB of memory"):
+            chain.has_equal_value(expr_code="f()")
+        # the process keeps working after running into the limit
+        chain.has_equal_value(expr_code="1")
+
+
+@pytest.mark.parametrize("mode", ["simple", "fork"])
+def test_async_grading(mode):
+    sol_code = "import time; time.sleep(0.5); x = 1"
+    submissions = ["import time; time.sleep(0.5); x = %d" % i for i in range(4)]
+    sct = "Ex().check_object('x').has_equal_value()"
+
+    async def grade(stu_code):
+        sol_process, stu_process, raw_output, error = await async_run_exercise(
+            "", sol_code, stu_code, mode=mode
+        )
+        return await async_test_exercise(
+            sct, stu_code, sol_code, "", stu_process, sol_process, raw_output, "", error
+        )
+
+    async def main():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.ensure_future(tick())
+        start = time.monotonic()
+        results = await asyncio.gather(*map(grade, submissions))
+        ticker.cancel()
+        return results, ticks, time.monotonic() - start
+
+    results, ticks, duration = asyncio.run(main())
+
+    assert [result["correct"] for result in results] == [False, True, False, False]
+    # the gradings ran at the same time, and didn't block the event loop
+    assert duration < 1.5
+    assert ticks > 20
+
+
+def test_async_scts_run_concurrently():
+    sol_code = "x = 1"
+    submissions = ["x = %d" % i for i in range(4)]
+    # the SCT waits before checking, e.g. for tasks in the processes
+    sct = "import time; time.sleep(0.5); Ex().check_object('x').has_equal_value()"
+
+    async def grade(stu_code):
+        sol_process, stu_process, raw_output, error = await async_run_exercise(
+            "", sol_code, stu_code, mode="stub"
+        )
+        return await async_test_exercise(
+            sct, stu_code, sol_code, "", stu_process, sol_process, raw_output, "", error
+        )
+
+    async def main():
+        start = time.monotonic()
+        results = await asyncio.gather(*map(grade, submissions))
+        return results, time.monotonic() - start
+
+    results, duration = asyncio.run(main())
+
+    # every SCT checked its own submission, at the same time
+    assert [result["correct"] for result in results] == [False, True, False, False]
+    assert duration < 1.5
+
+
+@pytest.mark.parametrize("mode", ["simple", "fork"])
+def test_async_run_exercise_doesnt_block(mode):
+    pec = "import time; time.sleep(0.5)"
+    solution_cache = SolutionCache(max_size=2)
+
+    async def main():
+        gaps = []
+
+        async def tick():
+            last = time.monotonic()
+            while True:
+                await asyncio.sleep(0.01)
+                gaps.append(time.monotonic() - last)
+                last = time.monotonic()
+
+        ticker = asyncio.ensure_future(tick())
+        with ForkServer(max_size=2) as server:
+            result = await async_run_exercise(
+                pec,
+                "x = 1",
+                "x = 2",
+                mode=mode,
+                server=server,
+                solution_cache=solution_cache,
+            )
+        ticker.cancel()
+        return result, gaps
+
+    try:
+        (sol_process, stu_process, raw_output, error), gaps = asyncio.run(main())
+    finally:
+        solution_cache.close()
+
+    assert error is None
+    assert getOptionFromProcess(stu_process, "x") == 2
+    # starting the processes, running the PEC and caching the solution happen
+    # in another thread
+    assert max(gaps) < 0.25
+
+
+@pytest.mark.parametrize("limit", [None, 10, 11, 1000])
+def test_bounded_output(limit):
+    text = "".join(str(i % 10) * i for i in range(50))
+    output = BoundedOutput(limit)
+    for i in range(50):
+        output.write(str(i % 10) * i)
+    value = output.getvalue()
+
+    if limit is None or limit >= len(text):
+        assert value == text
+        assert value.parts == [text]
+    else:
+        head, tail = value.parts
+        assert head == text[: limit // 2]
+        assert tail == text[-(limit - limit // 2) :]
+        assert value.dropped == len(text) - limit
+        assert "%d characters of output dropped" % value.dropped in value
+
+
 def write_file(path, name, content):
     os.makedirs(path)
     with ChDir(path):
@@ -0,0 +1,73 @@
+import os
+import sys
+
+import pytest
+from pythonwhat.local import ForkServer, TaskCaptureOutput, WorkerPool, preload_modules
+from pythonwhat.preload import PreloadManifest, imported_modules
+
+
+@pytest.mark.parametrize(
+    "codes, modules",
+    [
+        (["import numpy as np"], ("numpy",)),
+        (["import os.path, json"], ("os.path", "json")),
+        (["from collections import deque"], ("collections.deque",)),
+        (["import json", "import json\nimport csv"], ("json", "csv")),
+        (["def f():\n    import json"], ()),
+        (["from . import x", "import json"], ("json",)),
+        (["import json\nx = (", "import csv"], ("csv",)),
+    ],
+)
+def test_imported_modules(codes, modules):
+    assert imported_modules(*codes) == modules
+
+
+def test_preload_modules():
+    preload_modules(["xml.dom.minidom.parseString", "not_a_module.x"])
+    assert "xml.dom.minidom" in sys.modules
+
+
+def test_manifest(tmp_path):
+    manifest = PreloadManifest.from_exercises(
+        {
+            "ex_1": {"pre_exercise_code": "import json", "solution_code": "import csv"},
+            "ex_2": {"solution_code": "from json import dumps\nimport csv"},
+        }
+    )
+
+    assert manifest.exercises["ex_1"] == ("json", "csv")
+    assert manifest.modules("ex_2") == ("json.dumps", "csv")
+    assert manifest.modules() == ("json", "csv", "json.dumps")
+
+    path = tmp_path / "manifest.json"
+    manifest.save(path)
+    assert PreloadManifest.load(path).exercises == manifest.exercises
+
+
+def is_loaded(process, module):
+    code = "import sys\nprint(%r in sys.modules)" % module
+    output, error = process.executeTask(TaskCaptureOutput(code))
+    return output == "True\n"
+
+
+def test_pool_preloads_manifest():
+    manifest = PreloadManifest()
+    manifest.add("ex", solution_code="import mailbox as mb")
+    assert "mailbox" not in sys.modules
+
+    with WorkerPool(size=1, preload=manifest.modules("ex")) as pool:
+        process = pool.acquire()
+        try:
+            assert is_loaded(process, "mailbox")
+        finally:
+            process.kill()
+
+
+def test_fork_server_preloads():
+    assert "wave" not in sys.modules
+    with ForkServer(preload=["wave"]) as server:
+        process = server.fork("x = 1", os.getcwd())
+        try:
+            assert is_loaded(process, "wave")
+        finally:
+            process.kill()
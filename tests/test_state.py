@@ -1,7 +1,13 @@
+import ast
+import contextvars
+import threading
+
+import asttokens
 import pytest
 from protowhat.Reporter import Reporter
-from pythonwhat.State import State
+from pythonwhat.State import Dispatcher, ParseCache, State
 from protowhat.failure import InstructorError
+from pythonwhat.utils_ast import wrap_in_module
 
 
 def test_pec_parsing_error():
@@ -15,3 +21,105 @@ def test_pec_parsing_error():
             reporter=Reporter(),
             raw_student_output=None,
         )
+
+
+def make_state(code, pec=""):
+    return State(
+        student_code=code,
+        solution_code=code,
+        pre_exercise_code=pec,
+        student_process=None,
+        solution_process=None,
+        reporter=Reporter(),
+        raw_student_output=None,
+    )
+
+
+def test_parse_cache_shared():
+    code = "import numpy as np\nx = np.array([1])"
+    first = make_state(code, pec=code)
+    hits = Dispatcher.parse_cache.hits
+    second = make_state(code, pec=code)
+
+    assert second.student_ast is first.student_ast is first.solution_ast
+    assert second.ast_dispatcher.context_mappings == {"np": "numpy"}
+    # the mappings of the PEC and the parsed student and solution code
+    assert Dispatcher.parse_cache.hits == hits + 3
+
+
+def test_root_state_is_context_local(monkeypatch):
+    state = make_state("x = 1")
+    monkeypatch.setattr(State, "root_state", state)
+    seen = []
+    thread = threading.Thread(target=lambda: seen.append(State.root_state))
+    thread.start()
+    thread.join()
+
+    assert seen == [None]
+    assert State.root_state is state
+    assert contextvars.Context().run(lambda: State.root_state) is None
+
+
+def test_parse_cache_limits():
+    cache = ParseCache(max_size=2, max_chars=10)
+    for code in ["a = 1", "b = 2", "c = 3"]:
+        cache.get(code, "parse", lambda: code)
+    assert cache.get("b = 2", "parse", lambda: None) == "b = 2"
+    assert cache.stats() == {
+        "hits": 1,
+        "misses": 3,
+        "evictions": 1,
+        "size": 2,
+        "chars": 10,
+    }
+
+    cache.get("abcdefghijk", "parse", lambda: None)
+    cache.get("d = 4", "parse", lambda: None)
+    # c = 3 is the least recently used
+    assert set(cache.entries) == {cache.key("b = 2"), cache.key("d = 4")}
+
+
+def test_function_def_body_leaves_tree_unchanged():
+    tokens, tree = Dispatcher().parse("def f(x):\n    if x:\n        return 1\n")
+    body = Dispatcher().function_defs(tree)["f"]["body"]["node"]
+
+    assert isinstance(body.body[0].body[0], ast.Expr)
+    assert isinstance(tree.body[0].body[0].body[0], ast.Return)
+
+
+def test_to_child_shares_root_objects():
+    state = make_state("for i in range(3):\n    print(i)")
+    loop = state.ast_dispatcher.for_loops(state.student_ast)[0]
+    body = loop["body"]["node"]
+    child = state.to_child(student_ast=body, solution_ast=body)
+    grandchild = child.to_child()
+
+    for attr in ["ast_dispatcher", "converters", "representations", "reporter"]:
+        assert getattr(grandchild, attr) is getattr(state, attr)
+    assert child.student_code == "print(i)"
+    assert grandchild.parent_state is child
+
+    with pytest.raises(ValueError):
+        state.to_child(student_conn=None)
+
+
+def test_code_tokens_text():
+    code = "@dec\ndef f(x, *a):\n    return {'é': x}\n\ny = f(1)  # call\nz = (1, 2)"
+    tokens, tree = Dispatcher.parse_code(code)
+    atok = asttokens.ASTTokens(code, parse=True)
+
+    for node, atok_node in zip(ast.walk(tree), ast.walk(atok.tree)):
+        assert tokens.get_text(node) == atok.get_text(atok_node)
+    assert (
+        tokens.get_text(wrap_in_module(tree.body[1:])) == "y = f(1)  # call\nz = (1, 2)"
+    )
+
+
+def test_code_tokens_lazy():
+    code = "x = 1\nfor i in range(3):\n    print(i)"
+    state = make_state(code)
+    state.to_child(student_ast=state.student_ast.body[1].body)
+    assert state.student_ast_tokens._atok is None
+
+    state.student_ast_tokens.mark(state.student_ast)
+    assert state.student_ast.body[1].first_token.string == "for"
@@ -2,6 +2,11 @@ import json
 
 import pytest
 import tests.helper as helper
+from pythonwhat import local
+from pythonwhat.local import run_exercise
+from pythonwhat.State import State
+from pythonwhat.test_exercise import grade_batch, processes_needed
+from pythonwhat.test_exercise import test_exercise as run_sct
 
 
 @pytest.fixture(scope="session", autouse=True)
@@ -84,3 +89,203 @@ def test_enrichment_error():
     output = helper.run(data)
     assert not output["correct"]
     # assert not "line_start" in output
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_grade_batch(ordered):
+    exercise = {
+        "pre_exercise_code": "y = 2",
+        "solution_code": "x = 2 * y",
+        "sct": 'Ex().check_object("x").has_equal_value()\nsuccess_msg("nice")',
+    }
+    submissions = ["x = %d" % i for i in range(8)] + ["x = z"]
+
+    results = list(grade_batch(exercise, submissions, workers=2, ordered=ordered))
+
+    indices = [i for i, _ in results]
+    if ordered:
+        assert indices == list(range(len(submissions)))
+    assert sorted(indices) == list(range(len(submissions)))
+
+    outputs = dict(results)
+    assert [outputs[i]["correct"] for i in range(8)] == [i == 4 for i in range(8)]
+    assert outputs[4]["message"] == "nice"
+    assert not outputs[8]["correct"]
+
+
+def test_grade_batch_limits():
+    exercise = {
+        "pre_exercise_code": "",
+        "solution_code": "x = 1",
+        "sct": 'Ex().check_object("x").has_equal_value()',
+    }
+    submissions = ["while True: pass", "x = 1"]
+
+    outputs = dict(grade_batch(exercise, submissions, workers=1, time_limit=1))
+
+    assert not outputs[0]["correct"]
+    assert outputs[1]["correct"]
+
+
+def test_grade_batch_failing_gradings():
+    exercise = {
+        "pre_exercise_code": "",
+        "solution_code": "x = 1",
+        "sct": 'Ex().check_object("x").has_equal_value(expr_code="x[0]")',
+    }
+    submissions = ["x = 1", "x = 2"]
+
+    outputs = dict(grade_batch(exercise, submissions, workers=1))
+
+    assert sorted(outputs) == [0, 1]
+    for output in outputs.values():
+        assert not output["correct"]
+        assert output["error"].startswith("InstructorError")
+
+
+@pytest.mark.parametrize(
+    "sct, needed",
+    [
+        ("Ex().has_code('x')", set()),
+        ("Ex().check_function('print', signature=False).check_args(0)", set()),
+        ("Ex().check_for_loop().check_body().has_equal_ast(code=str(1))", set()),
+        ("Ex().has_output('x')", {"student"}),
+        ("Ex().multi(has_no_error(), has_code('x'))", {"student"}),
+        (
+            "Ex().check_function('print').check_args(0).has_equal_ast()",
+            {"student", "solution"},
+        ),
+        ("Ex().check_object('x').has_equal_value()", {"student", "solution"}),
+        ("test_object('x')", {"student", "solution"}),
+        ("def helper(): pass\nhelper()", {"student", "solution"}),
+        ("Ex(", {"student", "solution"}),
+    ],
+)
+def test_processes_needed(sct, needed):
+    assert processes_needed(sct) == needed
+
+
+@pytest.mark.parametrize(
+    "stu_code, correct, student_started",
+    [("y = 1", False, False), ("x = 1", True, True), ("x = 1; print(z)", False, True)],
+)
+def test_lazy_processes(stu_code, correct, student_started):
+    sct = "Ex().has_code('x')"
+    sol_process, stu_process, raw_output, error = run_exercise(
+        "", "x = 1", stu_code, needed=processes_needed(sct)
+    )
+
+    result = run_sct(
+        sct=sct,
+        student_code=stu_code,
+        solution_code="x = 1",
+        pre_exercise_code="",
+        student_process=stu_process,
+        solution_process=sol_process,
+        raw_student_output=raw_output,
+        ex_type="NormalExercise",
+        error=error,
+    )
+
+    assert result["correct"] == correct
+    assert stu_process.run.started == student_started
+    assert not sol_process.run.started
+
+
+def test_lazy_process_starts_when_used():
+    sct = "Ex().has_output('hi')\nEx().check_object('x').has_equal_value()"
+    sol_process, stu_process, raw_output, error = run_exercise(
+        "", "x = 1", "x = 1; print('hi')", needed=()
+    )
+
+    result = run_sct(
+        sct=sct,
+        student_code="x = 1",
+        solution_code="x = 1",
+        pre_exercise_code="",
+        student_process=stu_process,
+        solution_process=sol_process,
+        raw_student_output=raw_output,
+        ex_type="NormalExercise",
+        error=error,
+    )
+
+    assert result["correct"]
+    assert stu_process.run.started and sol_process.run.started
+
+
+@pytest.mark.parametrize("mode", ["simple", "stub"])
+@pytest.mark.parametrize(
+    "sct, correct",
+    [
+        ("Ex().check_object('x').has_equal_value()", True),
+        ("Ex().check_object('x').has_equal_value(override=2)", False),
+    ],
+)
+def test_trace(mode, sct, correct):
+    sol_process, stu_process, raw_output, error = run_exercise(
+        "", "x = 1", "x = 1", mode=mode
+    )
+
+    result = run_sct(
+        sct=sct,
+        student_code="x = 1",
+        solution_code="x = 1",
+        pre_exercise_code="",
+        student_process=stu_process,
+        solution_process=sol_process,
+        raw_student_output=raw_output,
+        ex_type="NormalExercise",
+        error=error,
+        trace=True,
+    )
+
+    assert result["correct"] == correct
+    timing = result["timing"]
+    assert "isDefinedInProcess" in timing["functions"]
+    assert timing["total"]["calls"] == len(timing["tasks"]) > 0
+    for task in timing["tasks"]:
+        assert task["run"] >= 0 and task["sent_bytes"] > 0
+    assert timing["parsing"]["hits"] > 0
+    assert local.tracer.get() is None
+
+
+def test_trace_without_state(monkeypatch):
+    sol_process, stu_process, raw_output, error = run_exercise(
+        "", "x = 1", "x = ", mode="stub"
+    )
+    monkeypatch.delattr(State, "root_state", raising=False)
+
+    result = run_sct(
+        sct="Ex().check_object('x')",
+        student_code="x = ",
+        solution_code="x = 1",
+        pre_exercise_code="",
+        student_process=stu_process,
+        solution_process=sol_process,
+        raw_student_output=raw_output,
+        ex_type="NormalExercise",
+        error=error,
+        trace=True,
+    )
+
+    assert not result["correct"]
+    assert "representations" not in result["timing"]
+
+
+def test_no_trace():
+    sol_process, stu_process, raw_output, error = run_exercise("", "x = 1", "x = 1")
+
+    result = run_sct(
+        sct="Ex().check_object('x')",
+        student_code="x = 1",
+        solution_code="x = 1",
+        pre_exercise_code="",
+        student_process=stu_process,
+        solution_process=sol_process,
+        raw_student_output=raw_output,
+        ex_type="NormalExercise",
+        error=error,
+    )
+
+    assert "timing" not in result
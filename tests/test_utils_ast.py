@@ -0,0 +1,121 @@
+import ast
+import copy
+
+import pytest
+from pythonwhat.utils import copy_env
+from pythonwhat.utils_ast import mutated_names
+
+setup = """
+import bisect
+import collections
+x = [[1, 2], [3]]
+y = {"a": [1], "b": (2, [3])}
+z = (1, [2])
+n = 3
+d = collections.defaultdict(list)
+"""
+
+
+def analyze(code, namespace):
+    return mutated_names([ast.parse(code)], namespace)
+
+
+@pytest.mark.parametrize(
+    "code, names",
+    [
+        ("x", set()),
+        ("x + [n] * 2 == y['a']", set()),
+        ("[v * 2 for v in x[0] if v > n]", set()),
+        ("len(x) + sum(sorted(y['a']))", set()),
+        ("print(x, y)", set()),
+        ("x = [1]\nx.append(2)", None),
+        ("del x", set()),
+        ("x.append(1)", {"x"}),
+        ("y['a'].append(x)", {"y", "x"}),
+        ("x[0] = n", {"x"}),
+        ("y['c'] = 1", {"y"}),
+        ("del y['a']", {"y"}),
+        ("x += [1]", {"x"}),
+        ("x[0] += [1]", {"x"}),
+        ("bisect.insort(x, n)", {"bisect", "x", "n"}),
+        ("with y['a']:\n    pass", {"y"}),
+        ("a = x\na.append(1)", None),
+        ("a = x\na += [1]", None),
+        ("[v.pop() for v in x]", None),
+        ("sorted(x, key=lambda v: v.pop())", None),
+        ("for v in x:\n    v.clear()", None),
+        ("def f():\n    x.clear()\nf()", None),
+        ("x[0](n)", None),
+        ("(lambda: 1)()", None),
+        ("list(map(x.pop, [0]))", {"x"}),
+        ("list(map(lambda v: v * 2, x))", set()),
+        ("sorted(z[1], key=x.append)", {"x"}),
+        ("list(filter(y.setdefault, 'ab'))", {"y"}),
+        ("max(x, key=len)", {"len"}),
+        ("len(d['k'])", {"d"}),
+        ("x[0][1] + y['b'][1][0]", set()),
+        ("[v[0] for v in x]", set()),
+        ("[len(v['k']) for v in [d]]", {"d"}),
+    ],
+)
+def test_mutated_names(code, names):
+    namespace = {}
+    exec(setup, namespace)
+    assert analyze(code, namespace) == names
+
+
+def test_mutated_names_shadowed_builtin():
+    namespace = {"len": lambda v: v.clear(), "x": [1]}
+    assert analyze("len(x)", {"x": [1]}) == set()
+    assert analyze("len(x)", namespace) is None
+
+
+@pytest.mark.parametrize(
+    "code",
+    [
+        "class A:\n    def __add__(self, other):\n        x.clear()",
+        "class A:\n    @property\n    def p(self):\n        x.clear()",
+        "def f():\n    x.clear()",
+    ],
+)
+def test_mutated_names_code_defined_in_namespace(code):
+    namespace = {}
+    exec(setup + code, namespace)
+    assert analyze("n + 1", namespace) is None
+
+
+corpus = [
+    "x",
+    "x[0] + y['a'] + list(z[1])",
+    "[v * 2 for v in x[1]]",
+    "x.append(1) or x",
+    "x[0].append(n) or x",
+    "y['b'][1].append(4) or y",
+    "y.update(a=5) or y",
+    "x.pop() and x",
+    "z[1].extend(x[0]) or z",
+    "bisect.insort(x[0], n) or x",
+    "x + z[1]",
+    "list(map(x.pop, [0])) and x",
+    "sorted(z[1], key=x[0].append) and x",
+    "list(filter(y.setdefault, 'cd')) and y",
+    "len(d['k']) + len(d)",
+    "[len(v['k']) for v in [d]] and d",
+]
+
+
+@pytest.mark.parametrize("code", corpus)
+def test_same_result_as_copy_env(code):
+    def run(names):
+        namespace = {}
+        exec(setup, namespace)
+        before = copy.deepcopy({key: namespace[key] for key in "xyznd"})
+        result = eval(code, copy_env(namespace, names(namespace)))
+        # the namespace didn't change
+        assert {key: namespace[key] for key in "xyznd"} == before
+        return result
+
+    full = run(lambda namespace: None)
+    analyzed = run(lambda namespace: analyze(code, namespace))
+
+    assert analyzed == full